@@ -0,0 +1,91 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+
+class EmbeddingBatcher:
+    """
+    Collect texts submitted by concurrent callers into micro-batches for a single encode call
+
+    A background thread waits for the first text, then keeps collecting texts for at
+    most max_wait_ms or until max_batch_size texts are queued, encodes them together
+    and resolves the future of every caller.
+
+    Attributes:
+        encode_fn (Callable): a function embedding a list of texts in one call
+        max_batch_size (int): the maximum number of texts encoded together
+        max_wait_ms (float): how long the first text of a batch waits for others to arrive
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], List[List[float]]],
+                 max_batch_size: int = 16, max_wait_ms: float = 5.0) -> None:
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.batched_texts = 0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self) -> None:
+        # The worker is started lazily so that it is created in the process serving requests
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """
+        Queue a text to be embedded with the next batch
+
+        Parameters:
+            text (str): the text to be embedded
+
+        Returns:
+            Future: resolves to the embedding of the text as a list of floats
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        """
+        Embed a text as part of a micro-batch and wait for the result
+        """
+        return self.submit(text).result()
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            self.batches += 1
+            self.batched_texts += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
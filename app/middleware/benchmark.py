@@ -0,0 +1,334 @@
+"""
+Load test and benchmark of the middleware against local stand-ins
+
+Starts the FastAPI app in-process with the fake embedding model, the fake LLM and a
+local k-NN index built from a sample of the chunk CSV, replays a query mix at a fixed
+concurrency and reports throughput and p50/p95/p99 latencies per endpoint and per
+pipeline stage (from the Server-Timing headers) as JSON.
+
+Usage:
+    python benchmark.py --csv data_embeddings.csv --requests 500 --concurrency 16 --output bench.json
+    python benchmark.py --csv data_embeddings.csv --queries query_log.jsonl --baseline bench.json
+
+A query log is a JSON lines file with one request per line, e.g.
+    {"endpoint": "dense_f", "query_str": "...", "filter": {"title": "", "years": ["2015-2020"], "keywords": []}}
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Endpoints of the query mix, by short name
+ENDPOINTS = {
+    "dense": "/retrieve_documents_dense",
+    "dense_f": "/retrieve_documents_dense_f",
+    "stream": "/retrieve_documents_dense_stream",
+    "batch": "/retrieve_documents_batch",
+}
+
+# Settings of the stand-ins, applied before the app reads config.py
+STAND_IN_SETTINGS = {
+    "VECTOR_STORE_BACKEND": "local",
+    "EMBEDDING_BACKEND": "fake",
+    "LLM_MODEL": "fake",
+    "EMBEDDING_CACHE_PATH": "",
+    "RERANK_MODEL": "",
+    "CONTEXT_TOKENIZER": "",
+    "ANSWER_CACHE_INDEX_CHECK": "3600",
+}
+
+
+def build_sample_index(csv_file: str, sample_size: int, destination_folder: str, dimension: int) -> List[dict]:
+    """
+    Build a local index from the first rows of the chunk CSV, embedded with the fake encoder
+
+    Parameters:
+        csv_file (str): the CSV of data_chunking.py or data_embedding.py
+        sample_size (int): the number of chunks to load
+        destination_folder (str): the folder of the local index
+        dimension (int): the length of the fake embeddings
+
+    Returns:
+        List[dict]: the title, chunk and year of every indexed chunk, to generate queries from
+    """
+    import pandas as pd
+    from fakes import HashingEncoder
+    from local_store import write_local_index
+
+    df = pd.read_csv(csv_file, nrows=sample_size)
+    df = df.dropna(subset=["chunk"]).reset_index(drop=True)
+    encoder = HashingEncoder(dimension=dimension)
+    embeddings = encoder.encode([{"text": chunk} for chunk in df["chunk"]])
+    write_local_index(df, embeddings.astype(np.float32), destination_folder)
+    return df[["title", "chunk", "year"]].to_dict("records")
+
+
+def synthetic_queries(chunks: List[dict], count: int, mix: Dict[str, float], duplicate_rate: float,
+                      seed: int) -> List[dict]:
+    """
+    Generate a query mix from the indexed chunks
+
+    Questions reuse words of a random chunk, filtered requests restrict the years around the
+    year of that chunk or require one of its words. A share of the requests repeats an earlier
+    question, as popular questions do.
+
+    Parameters:
+        chunks (List[dict]): the indexed chunks
+        count (int): the number of requests
+        mix (Dict[str, float]): the weight of each endpoint short name
+        duplicate_rate (float): the share of requests repeating an earlier question
+        seed (int): the seed of the random generator
+
+    Returns:
+        List[dict]: the requests, in the query log format
+    """
+    generator = random.Random(seed)
+    names, weights = zip(*mix.items())
+    queries = []
+    for _ in range(count):
+        if queries and generator.random() < duplicate_rate:
+            queries.append(dict(generator.choice(queries)))
+            continue
+
+        chunk = generator.choice(chunks)
+        words = re.findall(r"[A-Za-z]{4,}", f"{chunk['title']} {chunk['chunk']}") or ["treatment"]
+        query = {
+            "endpoint": generator.choices(names, weights)[0],
+            "query_str": "What is known about " + " ".join(generator.sample(words, min(4, len(words)))) + "?",
+        }
+        if query["endpoint"] in ("dense_f", "batch"):
+            filter_data = {"title": "", "years": [], "keywords": []}
+            if generator.random() < 0.5:
+                year = int(float(chunk["year"]))
+                filter_data["years"] = [f"{year - 2}-{year + 2}"]
+            else:
+                filter_data["keywords"] = [generator.choice(words).lower()]
+            query["filter"] = filter_data
+        queries.append(query)
+    return queries
+
+
+def load_query_log(path: str, count: int) -> List[dict]:
+    """
+    Read a recorded query log, repeated in order until count requests are reached
+    """
+    with open(path) as file:
+        log = [json.loads(line) for line in file if line.strip()]
+    return [dict(log[position % len(log)]) for position in range(count)]
+
+
+def _request(base_url: str, query: dict) -> urllib.request.Request:
+    endpoint = query.get("endpoint", "dense")
+    path = ENDPOINTS[endpoint]
+    if endpoint in ("dense", "stream"):
+        parameters = urllib.parse.urlencode({"query_str": query["query_str"]})
+        return urllib.request.Request(f"{base_url}{path}?{parameters}")
+
+    if endpoint == "dense_f":
+        body = {"query_str": query["query_str"], "filter": query.get("filter") or {"title": "", "years": [], "keywords": []}}
+    else:
+        # One batch request carries a few variations of the question
+        body = {"questions": [
+            {"query_str": query["query_str"] + suffix, "filter": query.get("filter")} for suffix in ["", " Why?", " How?"]
+        ]}
+    return urllib.request.Request(
+        f"{base_url}{path}", data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}
+    )
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """
+    Parse a Server-Timing header into stage durations in milliseconds
+    """
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, parameters = entry.strip().partition(";")
+        match = re.search(r"dur=([0-9.]+)", parameters)
+        if name and match:
+            timings[name] = float(match.group(1))
+    return timings
+
+
+def send(base_url: str, query: dict, timeout: float) -> dict:
+    """
+    Send one request and measure its latency, the whole body is read (all streamed tokens)
+    """
+    started = time.perf_counter()
+    result = {"endpoint": query.get("endpoint", "dense"), "ok": False, "stages": {}}
+    try:
+        with urllib.request.urlopen(_request(base_url, query), timeout=timeout) as response:
+            response.read()
+            result["ok"] = response.status == 200
+            result["stages"] = parse_server_timing(response.headers.get("Server-Timing"))
+    except Exception as error:
+        result["error"] = str(error)
+    result["latency_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(float(np.mean(values)), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+    }
+
+
+def run_load(base_url: str, queries: List[dict], concurrency: int, timeout: float) -> dict:
+    """
+    Replay the queries with a closed loop of concurrency clients and summarize the results
+    """
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda query: send(base_url, query, timeout), queries))
+    duration = time.perf_counter() - started
+
+    summary = {
+        "requests": len(results),
+        "errors": sum(not result["ok"] for result in results),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(sum(result["ok"] for result in results) / duration, 2),
+        "endpoints": {},
+        "stages": {},
+    }
+    for endpoint in sorted({result["endpoint"] for result in results}):
+        selected = [result for result in results if result["endpoint"] == endpoint]
+        summary["endpoints"][endpoint] = percentiles([result["latency_ms"] for result in selected if result["ok"]])
+        summary["endpoints"][endpoint]["errors"] = sum(not result["ok"] for result in selected)
+    for stage in sorted({stage for result in results for stage in result["stages"]}):
+        summary["stages"][stage] = percentiles([result["stages"][stage] for result in results if stage in result["stages"]])
+    return summary
+
+
+def start_server(port: int, startup_timeout: float) -> str:
+    """
+    Start the middleware with uvicorn in a background thread and wait until it is ready
+
+    Returns:
+        str: the base URL of the server
+    """
+    import uvicorn
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="benchmark-server", daemon=True).start()
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/health/ready", timeout=5) as response:
+                if response.status == 200:
+                    return base_url
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"The middleware was not ready after {startup_timeout} seconds")
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> List[str]:
+    """
+    List the regressions against a baseline: lower throughput, or higher p95 per endpoint
+
+    Parameters:
+        results (dict): the current benchmark results
+        baseline (dict): the results of an earlier run
+        max_regression (float): the tolerated relative regression, e.g. 0.1 for 10 %
+
+    Returns:
+        List[str]: a description of every regression beyond the tolerance
+    """
+    regressions = []
+    if results["throughput_rps"] < baseline["throughput_rps"] * (1 - max_regression):
+        regressions.append(f"throughput {results['throughput_rps']} rps < baseline {baseline['throughput_rps']} rps")
+    for endpoint, stats in results["endpoints"].items():
+        previous = baseline["endpoints"].get(endpoint, {})
+        if "p95_ms" in stats and "p95_ms" in previous and stats["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{endpoint} p95 {stats['p95_ms']} ms > baseline {previous['p95_ms']} ms")
+    return regressions
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for entry in mix.split(","):
+        name, _, weight = entry.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint {name.strip()}, expected one of {list(ENDPOINTS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the middleware against local stand-ins")
+    parser.add_argument("--csv", required=True, help="chunk CSV (data_chunking.py or data_embedding.py output)")
+    parser.add_argument("--sample", type=int, default=5000, help="number of chunks loaded into the local index")
+    parser.add_argument("--queries", default="", help="recorded query log (JSON lines), synthetic queries if empty")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", default="dense=2,dense_f=2,stream=1,batch=1", help="endpoint weights of synthetic queries")
+    parser.add_argument("--duplicate-rate", type=float, default=0.2, help="share of synthetic repeated questions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--token-ms", type=float, default=20.0, help="fake LLM latency per token")
+    parser.add_argument("--tokens", type=int, default=64, help="fake LLM tokens per answer")
+    parser.add_argument("--embedding-ms", type=float, default=20.0, help="fake embedding latency per batch")
+    parser.add_argument("--dimension", type=int, default=1024, help="fake embedding dimension")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=120.0, help="timeout per request in seconds")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="", help="earlier results to gate regressions against")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    index_folder = tempfile.mkdtemp(prefix="benchmark_index_")
+    os.environ.update(STAND_IN_SETTINGS)
+    os.environ.update({
+        "LOCAL_STORE_PATH": index_folder,
+        "FAKE_EMBEDDING_DIMENSION": str(args.dimension),
+        "FAKE_EMBEDDING_MS": str(args.embedding_ms),
+        "FAKE_LLM_TOKENS": str(args.tokens),
+        "FAKE_LLM_TOKEN_MS": str(args.token_ms),
+    })
+
+    print(f"Building the local index from {args.sample} chunks of {args.csv}...")
+    chunks = build_sample_index(args.csv, args.sample, index_folder, args.dimension)
+
+    if args.queries:
+        queries = load_query_log(args.queries, args.warmup + args.requests)
+    else:
+        queries = synthetic_queries(chunks, args.warmup + args.requests, parse_mix(args.mix), args.duplicate_rate, args.seed)
+
+    print("Starting the middleware...")
+    base_url = start_server(args.port, startup_timeout=300)
+
+    run_load(base_url, queries[:args.warmup], args.concurrency, args.timeout)
+    print(f"Sending {args.requests} requests with a concurrency of {args.concurrency}...")
+    results = run_load(base_url, queries[args.warmup:], args.concurrency, args.timeout)
+    results["settings"] = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.max_regression)
+        for regression in regressions:
+            print("Regression: ", regression)
+        sys.exit(1 if regressions else 0)
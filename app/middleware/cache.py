@@ -0,0 +1,290 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional
+
+import numpy as np
+
+from metrics import cache_events
+
+
+class TTLCache:
+    """
+    A thread-safe in-process cache with LRU eviction and a time-to-live per entry
+
+    Attributes:
+        max_size (int): the maximum number of entries kept in memory
+        ttl (float): the number of seconds an entry stays valid, 0 disables expiry
+        name (str): the cache name in the metrics, empty string to leave the cache out
+        hits (int): the number of successful lookups
+        misses (int): the number of failed lookups (absent or expired)
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0, name: str = "") -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Hashable):
+        """
+        Look up a key and mark it as recently used
+
+        Parameters:
+            key (Hashable): the cache key
+
+        Returns:
+            the cached value, or None if the key is absent or expired
+        """
+        value = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[0]):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                result = "miss"
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                result = "hit"
+                value = entry[1]
+        if self.name:
+            cache_events.inc(cache=self.name, result=result)
+        return value
+
+    def put(self, key: Hashable, value) -> None:
+        """
+        Store a value and evict the least recently used entries above max_size
+
+        Parameters:
+            key (Hashable): the cache key
+            value: the value to store
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so that trivially different spellings share a cache entry
+
+    UAE-Large-V1 uses an uncased tokenizer, so case and repeated whitespace do not
+    change the embedding.
+    """
+    return " ".join(query.split()).lower()
+
+
+class EmbeddingCache(TTLCache):
+    """
+    Cache for query embeddings keyed by the normalized query text and the prompt type
+
+    An optional SQLite file acts as a persistent second tier, so embeddings
+    survive restarts of the middleware.
+
+    Attributes:
+        path (str): the location of the SQLite file, empty string for memory only
+        disk_hits (int): the number of lookups answered from the persistent tier
+    """
+
+    def __init__(self, max_size: int = 2048, ttl: float = 0, path: str = "") -> None:
+        super().__init__(max_size=max_size, ttl=ttl, name="embedding")
+        self.path = path
+        self.disk_hits = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            # Several worker processes may share the file: wait for locks and let readers run during writes
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, stored_at REAL, embedding TEXT)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(query: str, prompt_type: str) -> str:
+        return f"{prompt_type}|{normalize_query(query)}"
+
+    def get_embedding(self, query: str, prompt_type: str) -> Optional[List[float]]:
+        """
+        Look up the embedding of a query in memory first, then in the persistent tier
+
+        Parameters:
+            query (str): the raw query text
+            prompt_type (str): the type of prompt used to embed the text, e.g. query or passage
+
+        Returns:
+            List[float]: the cached embedding, or None on a miss
+        """
+        key = self.make_key(query, prompt_type)
+        embedding = self.get(key)
+        if embedding is not None or self._db is None:
+            return embedding
+
+        with self._db_lock:
+            row = self._db.execute("SELECT stored_at, embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        # Wall clock time is used on disk since monotonic time does not survive restarts
+        if row is None or (self.ttl > 0 and time.time() - row[0] > self.ttl):
+            cache_events.inc(cache="embedding_disk", result="miss")
+            return None
+
+        embedding = json.loads(row[1])
+        self.disk_hits += 1
+        cache_events.inc(cache="embedding_disk", result="hit")
+        super().put(key, embedding)
+        return embedding
+
+    def put_embedding(self, query: str, prompt_type: str, embedding: List[float]) -> None:
+        """
+        Store the embedding of a query in memory and in the persistent tier if enabled
+        """
+        key = self.make_key(query, prompt_type)
+        self.put(key, embedding)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", (key, time.time(), json.dumps(embedding))
+                )
+                self._db.commit()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["disk_hits"] = self.disk_hits
+        return stats
+
+
+class AnswerCache:
+    """
+    Cache for end-to-end RAG answers with an exact and a semantic lookup
+
+    Entries are scoped by a tuple such as (filter, index version, prompt version), so an
+    answer is only reused for the same filter, index and prompt. The exact lookup uses the
+    normalized query text, the semantic lookup reuses the answer of a cached query whose
+    embedding is within the cosine similarity threshold.
+
+    Attributes:
+        similarity_threshold (float): the minimum cosine similarity for a semantic hit, 1 or more disables it
+        semantic_hits (int): the number of lookups answered by a similar query
+    """
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600, similarity_threshold: float = 0.97) -> None:
+        self.similarity_threshold = similarity_threshold
+        self.semantic_hits = 0
+        self._answers = TTLCache(max_size=max_size, ttl=ttl, name="answer")
+        # scope -> OrderedDict(exact key -> unit length query embedding)
+        self._vectors = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, scope: tuple) -> tuple:
+        return (normalize_query(query),) + tuple(scope)
+
+    def lookup(self, query: str, scope: tuple, embedding: Optional[List[float]] = None):
+        """
+        Find a cached answer for the query within the scope
+
+        Parameters:
+            query (str): the question asked by the user
+            scope (tuple): the filter, index and prompt versions the answer must match
+            embedding (List[float]): the query embedding, None skips the semantic lookup
+
+        Returns:
+            the cached answer, or None on a miss
+        """
+        answer = self.lookup_exact(query, scope)
+        if answer is not None or embedding is None:
+            return answer
+        return self.lookup_similar(scope, embedding)
+
+    def lookup_exact(self, query: str, scope: tuple):
+        """
+        Find the cached answer of the same normalized query within the scope, None on a miss
+        """
+        return self._answers.get(self.make_key(query, scope))
+
+    def lookup_similar(self, scope: tuple, embedding: List[float]):
+        """
+        Find the cached answer of the most similar query within the scope, None on a miss
+        """
+        if self.similarity_threshold >= 1:
+            return None
+
+        with self._lock:
+            vectors = self._vectors.get(tuple(scope))
+            if not vectors:
+                return None
+            keys = list(vectors.keys())
+            matrix = np.stack(list(vectors.values()))
+
+        similarities = matrix @ _unit(embedding)
+        for position in np.argsort(-similarities):
+            if similarities[position] < self.similarity_threshold:
+                break
+            # The exact entry may have expired or been evicted since, then forget its vector
+            answer = self._answers.get(keys[position])
+            if answer is not None:
+                self.semantic_hits += 1
+                cache_events.inc(cache="answer_semantic", result="hit")
+                return answer
+            with self._lock:
+                vectors.pop(keys[position], None)
+        return None
+
+    def store(self, query: str, scope: tuple, answer, embedding: Optional[List[float]] = None) -> None:
+        """
+        Store the answer for the query, and its embedding for semantic lookups
+        """
+        key = self.make_key(query, scope)
+        self._answers.put(key, answer)
+        if embedding is None:
+            return
+
+        with self._lock:
+            vectors = self._vectors.setdefault(tuple(scope), OrderedDict())
+            vectors[key] = _unit(embedding)
+            vectors.move_to_end(key)
+            while len(vectors) > self._answers.max_size:
+                vectors.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """
+        Drop every cached answer, e.g. after the index was rebuilt
+        """
+        self._answers.clear()
+        with self._lock:
+            self._vectors.clear()
+
+    def stats(self) -> dict:
+        stats = self._answers.stats()
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
+
+
+def _unit(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
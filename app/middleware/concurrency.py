@@ -0,0 +1,252 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+from config import STAGE_LIMIT_EMBEDDING, STAGE_LIMIT_OPENSEARCH, STAGE_LIMIT_LLM
+from config import LLM_QUEUE_INTERACTIVE, LLM_QUEUE_BATCH
+from metrics import stage_wait_seconds, coalesced_requests
+
+
+class StageLimiter:
+    """
+    Bound the number of concurrent calls per stage of the RAG pipeline
+
+    Callers beyond the limit of a stage wait in line for a free slot instead of
+    piling onto the model, OpenSearch or the LLM provider.
+
+    Attributes:
+        limits (dict): the maximum number of concurrent calls per stage name
+    """
+
+    def __init__(self, limits: dict) -> None:
+        self.limits = dict(limits)
+        self._semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in limits.items()}
+        self._waiting = {name: 0 for name in limits}
+        self._active = {name: 0 for name in limits}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Hold a slot of the stage for the duration of the with block
+
+        Parameters:
+            name (str): the stage name, e.g. embedding, opensearch or llm
+        """
+        semaphore = self._semaphores[name]
+        with self._lock:
+            self._waiting[name] += 1
+        started = time.perf_counter()
+        semaphore.acquire()
+        stage_wait_seconds.observe(time.perf_counter() - started, stage=name)
+        with self._lock:
+            self._waiting[name] -= 1
+            self._active[name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[name] -= 1
+            semaphore.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {"limit": self.limits[name], "active": self._active[name], "waiting": self._waiting[name]}
+                for name in self.limits
+            }
+
+
+class Overloaded(Exception):
+    """
+    A call was not admitted: its queue was full (reason "queue_full") or its deadline passed while waiting ("deadline")
+    """
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionQueue:
+    """
+    Bounded, prioritized admission to a stage with a fixed number of slots
+
+    Waiting callers are served by lane, in the order the lanes are given, and first come
+    first served within a lane. Each lane has a bounded number of waiting callers, and a
+    caller gives up when its deadline passes, so an overloaded stage fails fast instead of
+    queueing without bound.
+
+    Attributes:
+        name (str): the stage name in the metrics
+        slots (int): the maximum number of concurrent calls
+        lane_limits (dict): the maximum number of waiting callers per lane
+    """
+
+    def __init__(self, name: str, slots: int, lane_limits: dict) -> None:
+        self.name = name
+        self.slots = slots
+        self.lane_limits = dict(lane_limits)
+        self._priorities = {lane: priority for priority, lane in enumerate(lane_limits)}
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._queue = []
+        self._active = 0
+        self._waiting = {lane: 0 for lane in lane_limits}
+        self._rejected = {lane: 0 for lane in lane_limits}
+        self._expired = {lane: 0 for lane in lane_limits}
+
+    def acquire(self, lane: str, deadline: Optional[float] = None) -> None:
+        """
+        Wait for a slot, in priority order
+
+        Parameters:
+            lane (str): the lane of the caller, e.g. interactive or batch
+            deadline (float): the time.monotonic() after which the caller gives up, None waits forever
+
+        Raises:
+            Overloaded: if the lane is full or the deadline passes before a slot is free
+        """
+        started = time.perf_counter()
+        with self._condition:
+            if self._active < self.slots and not self._queue:
+                self._active += 1
+                stage_wait_seconds.observe(0.0, stage=self.name)
+                return
+            if self._waiting[lane] >= self.lane_limits[lane]:
+                self._rejected[lane] += 1
+                raise Overloaded("queue_full")
+
+            ticket = (self._priorities[lane], next(self._sequence))
+            heapq.heappush(self._queue, ticket)
+            self._waiting[lane] += 1
+            try:
+                while self._active >= self.slots or self._queue[0] != ticket:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self._expired[lane] += 1
+                        self._queue.remove(ticket)
+                        heapq.heapify(self._queue)
+                        raise Overloaded("deadline")
+                    self._condition.wait(remaining)
+                heapq.heappop(self._queue)
+                self._active += 1
+            finally:
+                self._waiting[lane] -= 1
+                # The head of the queue changed, the next caller may be admissible
+                self._condition.notify_all()
+        stage_wait_seconds.observe(time.perf_counter() - started, stage=self.name)
+
+    def release(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, lane: str, deadline: Optional[float] = None):
+        """
+        Hold a slot for the duration of the with block, see acquire
+        """
+        self.acquire(lane, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "limit": self.slots,
+                "active": self._active,
+                "waiting": len(self._queue),
+                "lanes": {
+                    lane: {
+                        "waiting": self._waiting[lane],
+                        "max_waiting": self.lane_limits[lane],
+                        "rejected": self._rejected[lane],
+                        "expired": self._expired[lane],
+                    }
+                    for lane in self.lane_limits
+                },
+            }
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Share one in-flight computation between concurrent callers with the same key
+
+    The first caller of a key runs the computation, callers arriving while it runs wait
+    for it and receive the same result (or exception) instead of computing it again.
+
+    Attributes:
+        name (str): the name in the metrics
+        coalesced (int): the number of callers that received the result of another caller
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute: Callable[[], Any]) -> Any:
+        """
+        Run the computation for a key, or wait for the one already running
+
+        Parameters:
+            key (Hashable): identifies identical computations
+            compute (Callable): the computation, called without arguments
+
+        Returns:
+            the result of the computation
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            coalesced_requests.inc(flight=self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "coalesced": self.coalesced}
+
+
+stage_limiter = StageLimiter({
+    "embedding": STAGE_LIMIT_EMBEDDING,
+    "opensearch": STAGE_LIMIT_OPENSEARCH,
+})
+
+# Generation is admitted separately, with interactive requests ahead of batch requests
+llm_admission = AdmissionQueue("llm", STAGE_LIMIT_LLM, {
+    "interactive": LLM_QUEUE_INTERACTIVE,
+    "batch": LLM_QUEUE_BATCH,
+})
@@ -0,0 +1,129 @@
+import random
+import threading
+import time
+
+from opensearchpy import OpenSearch
+from opensearchpy.exceptions import ConnectionError, TransportError
+
+from config import OPENSEARCH_HOST, OPENSEARCH_PORT, OPENSEARCH_AUTH, OPENSEARCH_POOL_SIZE
+from config import OPENSEARCH_TIMEOUT, OPENSEARCH_MAX_RETRIES, OPENSEARCH_RETRY_BACKOFF
+
+# Status codes worth retrying, the node is busy or restarting
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+_client = None
+_async_client = None
+_lock = threading.Lock()
+_calls = {"active": 0, "total": 0, "retries": 0, "failures": 0}
+
+
+def _client_settings() -> dict:
+    return {
+        "hosts": [{"host": OPENSEARCH_HOST, "port": OPENSEARCH_PORT}],
+        "http_auth": OPENSEARCH_AUTH,
+        "use_ssl": True,
+        "verify_certs": False,
+        "ssl_show_warn": False,
+        "timeout": OPENSEARCH_TIMEOUT,
+        # Retries are done with backoff by call_with_retries
+        "max_retries": 0,
+    }
+
+
+def get_client() -> OpenSearch:
+    """
+    Return the OpenSearch client shared by all retrieval paths of the process
+
+    Returns:
+        OpenSearch: a client with a keep-alive connection pool sized to the worker concurrency
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            # Sized to the number of concurrent OpenSearch calls, idle connections are kept alive
+            _client = OpenSearch(**_client_settings(), pool_maxsize=OPENSEARCH_POOL_SIZE)
+    return _client
+
+
+def get_async_client():
+    """
+    Return the AsyncOpenSearch client shared by all async retrieval paths of the process
+
+    Returns:
+        AsyncOpenSearch: an async client (aiohttp) with the same pool settings as get_client
+    """
+    global _async_client
+    from opensearchpy import AsyncOpenSearch
+
+    with _lock:
+        if _async_client is None:
+            # The aiohttp connection names its pool size maxsize, pool_maxsize would be ignored
+            _async_client = AsyncOpenSearch(**_client_settings(), maxsize=OPENSEARCH_POOL_SIZE)
+    return _async_client
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, ConnectionError):
+        return True
+    return isinstance(error, TransportError) and error.status_code in RETRY_STATUS_CODES
+
+
+def call_with_retries(method, *args, **kwargs):
+    """
+    Call an OpenSearch client method with a per-call timeout and retry with exponential backoff
+
+    Parameters:
+        method (Callable): a bound client method, e.g. get_client().search
+        args, kwargs: the arguments of the call, request_timeout defaults to OPENSEARCH_TIMEOUT
+
+    Returns:
+        the response of the call
+    """
+    kwargs.setdefault("request_timeout", OPENSEARCH_TIMEOUT)
+    with _lock:
+        _calls["active"] += 1
+        _calls["total"] += 1
+    try:
+        for attempt in range(OPENSEARCH_MAX_RETRIES + 1):
+            try:
+                return method(*args, **kwargs)
+            except Exception as error:
+                if attempt == OPENSEARCH_MAX_RETRIES or not _retryable(error):
+                    with _lock:
+                        _calls["failures"] += 1
+                    raise
+                with _lock:
+                    _calls["retries"] += 1
+                # Full jitter so that concurrent retries do not hit the node at the same time
+                time.sleep(random.uniform(0, OPENSEARCH_RETRY_BACKOFF * 2 ** attempt))
+    finally:
+        with _lock:
+            _calls["active"] -= 1
+
+
+def pool_stats() -> dict:
+    """
+    Report the utilization of the shared connection pool
+
+    Returns:
+        dict: the call counters and, per node, the pool size, open connections and connections in use
+    """
+    with _lock:
+        stats = dict(_calls)
+    stats["pools"] = []
+    if _client is None:
+        return stats
+
+    for connection in _client.transport.connection_pool.connections:
+        pool = getattr(connection, "pool", None)
+        if pool is None:
+            continue
+        stats["pools"].append({
+            "host": connection.host,
+            "max_size": pool.pool.maxsize,
+            "opened": pool.num_connections,
+            # Free slots (idle connections or not yet opened) wait in the queue
+            "in_use": pool.pool.maxsize - pool.pool.qsize(),
+            "requests": pool.num_requests,
+        })
+    return stats
@@ -0,0 +1,113 @@
+import re
+from typing import Callable, List
+
+from langchain_core.documents.base import Document
+
+# Sentence boundaries of PubMed abstracts: end punctuation followed by whitespace
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+
+def approximate_token_count(text: str) -> int:
+    """
+    Estimate the number of tokens of an English text (about 4 characters per token)
+    """
+    return (len(text) + 3) // 4
+
+
+def token_counter(tokenizer_name: str = "") -> Callable[[str], int]:
+    """
+    Create a function counting the tokens of a text for the target LLM
+
+    Parameters:
+        tokenizer_name (str): the HuggingFace tokenizer of the LLM, empty string for the approximation
+
+    Returns:
+        Callable[[str], int]: the token counting function
+    """
+    if not tokenizer_name:
+        return approximate_token_count
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def _overlap(left: str, right: str, max_overlap: int) -> int:
+    """
+    Length of the longest suffix of left that is a prefix of right
+    """
+    for size in range(min(len(left), len(right), max_overlap), 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def merge_overlapping_chunks(documents: List[Document], max_overlap: int = 200) -> List[Document]:
+    """
+    Merge consecutive chunks of the same abstract into one text without the repeated overlap
+
+    The index is built with overlapping chunks (e.g. pubmed_500_100), so chunk n+1 of
+    a PMID starts with the end of chunk n. Merged documents keep the rank of their best chunk.
+
+    Parameters:
+        documents (List[Document]): the retrieved chunks, best first
+        max_overlap (int): the longest overlap in characters to look for
+
+    Returns:
+        List[Document]: the merged documents, best first
+    """
+    groups = {}
+    for document in documents:
+        groups.setdefault(document.metadata.get("pmid"), []).append(document)
+
+    merged = []
+    for chunks in groups.values():
+        chunks = sorted(chunks, key=lambda chunk: chunk.metadata.get("chunk_id", 0))
+        text, metadata = chunks[0].page_content, dict(chunks[0].metadata)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            if chunk.metadata.get("chunk_id", 0) == previous.metadata.get("chunk_id", 0) + 1:
+                text += chunk.page_content[_overlap(text, chunk.page_content, max_overlap):]
+            else:
+                merged.append(Document(page_content=text, metadata=metadata))
+                text, metadata = chunk.page_content, dict(chunk.metadata)
+        merged.append(Document(page_content=text, metadata=metadata))
+    return merged
+
+
+def pack_context(documents: List[Document], token_budget: int,
+                 count_tokens: Callable[[str], int] = approximate_token_count) -> List[Document]:
+    """
+    Build the LLM context: merge overlapping chunks, drop repeated sentences and fit the token budget
+
+    Parameters:
+        documents (List[Document]): the retrieved chunks, best first
+        token_budget (int): the maximum number of context tokens, 0 disables the limit
+        count_tokens (Callable[[str], int]): counts the tokens of a text for the target LLM
+
+    Returns:
+        List[Document]: the documents to stuff into the prompt, best first
+    """
+    seen = set()
+    used = 0
+    packed = []
+    for document in merge_overlapping_chunks(documents):
+        sentences = []
+        for sentence in SENTENCE_SPLIT.split(document.page_content.strip()):
+            key = " ".join(sentence.split()).lower()
+            if not key or key in seen:
+                continue
+            # The highest ranked content is kept, the rest is cut at a sentence boundary
+            if token_budget > 0:
+                tokens = count_tokens(sentence)
+                if used + tokens > token_budget:
+                    break
+                used += tokens
+            seen.add(key)
+            sentences.append(sentence)
+
+        if sentences:
+            packed.append(Document(page_content=" ".join(sentences), metadata=document.metadata))
+        if token_budget > 0 and used >= token_budget:
+            break
+    return packed
@@ -0,0 +1,86 @@
+"""
+Deterministic stand-ins for the embedding model and the LLM
+
+They let the middleware run without model weights, a GPU or API tokens while keeping
+the costs that matter for throughput: a fixed latency per embedding batch and per
+generated token. Selected with EMBEDDING_BACKEND=fake and LLM_MODEL=fake in config.py.
+"""
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Optional, Union
+
+import numpy as np
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class HashingEncoder:
+    """
+    AnglE-compatible encoder that embeds texts as hashed bags of words
+
+    Texts sharing words get similar unit vectors, so k-NN search and the semantic
+    answer cache behave plausibly. Each encode call sleeps latency_ms to stand in for
+    the forward pass of the real model.
+
+    Attributes:
+        dimension (int): the length of the embeddings
+        latency_ms (float): the simulated cost of one encode call
+    """
+
+    def __init__(self, dimension: int = 1024, latency_ms: float = 0.0) -> None:
+        self.dimension = dimension
+        self.latency_ms = latency_ms
+        self.prompt = None
+
+    def set_prompt(self, prompt: Any = None) -> None:
+        self.prompt = prompt
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            position = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[position] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def encode(self, inputs: Union[dict, List[dict]], to_numpy: bool = True) -> np.ndarray:
+        if isinstance(inputs, dict):
+            inputs = [inputs]
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000)
+        return np.stack([self._embed(item["text"]) for item in inputs])
+
+
+class FakeTokenLLM(LLM):
+    """
+    LLM that echoes words of the prompt after "Answer:", one token every token_ms milliseconds
+
+    Attributes:
+        tokens (int): the number of generated tokens per answer
+        token_ms (float): the simulated generation time per token
+    """
+
+    tokens: int = 64
+    token_ms: float = 20.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-token"
+
+    def _tokens(self, prompt: str) -> List[str]:
+        words = prompt.split() or ["answer"]
+        generated = ["Answer:"] + [words[position % len(words)] for position in range(self.tokens)]
+        return [token + " " for token in generated]
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        tokens = self._tokens(prompt)
+        time.sleep(len(tokens) * self.token_ms / 1000)
+        return "".join(tokens)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        for token in self._tokens(prompt):
+            time.sleep(self.token_ms / 1000)
+            yield GenerationChunk(text=token)
@@ -0,0 +1,285 @@
+"""
+Compiler for retrieval filter specs
+
+A filter spec is a dictionary, every field that is set must hold (AND):
+
+- title: the title contains this string
+- years: the year is one of these entries, "2020" or an inclusive range "2015-2020"
+- keywords: the text contains all of these keywords
+- any_keywords: the text contains at least one of these keywords
+- exclude_years: the year is none of these entries
+- exclude_keywords: the text contains none of these keywords
+- any_of: at least one of these sub-specs holds (OR)
+- none_of: none of these sub-specs holds (NOT)
+
+All string matching is case insensitive and on substrings, e.g. the keyword "diabet" matches
+"diabetes". A spec is compiled once into a predicate that checks every document in a single
+pass, and into an OpenSearch bool query that pre-filters the candidates.
+
+The OpenSearch query only carries the criteria it can evaluate without losing matches: the
+analyzed text fields match whole words, not substrings, so title, keywords and any_keywords
+stay in Python. Years are pushed down exactly. Excluded single-word keywords are pushed down
+as a pre-filter: a document containing the word also contains the substring, so it would be
+dropped in Python anyway. The predicate is always applied to the returned candidates.
+"""
+import json
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+from langchain_core.documents.base import Document
+
+
+LEAF_FIELDS = ["title", "years", "keywords", "any_keywords", "exclude_years", "exclude_keywords"]
+GROUP_FIELDS = ["any_of", "none_of"]
+
+
+class NormalizedDocument:
+    """
+    The lowercased title and text and the integer year of a document, computed once per filter pass
+    """
+
+    __slots__ = ("title", "text", "year")
+
+    def __init__(self, document: Document) -> None:
+        self.title = str(document.metadata.get("title", "")).lower()
+        self.text = document.page_content.lower()
+        self.year = _parse_year(document.metadata.get("year"))
+
+
+def _parse_year(year) -> Optional[int]:
+    try:
+        return int(float(year))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_year_ranges(years: List[str]) -> List[Tuple[int, int]]:
+    """
+    Parse year entries into sorted, non-overlapping inclusive (start, end) ranges
+
+    Parameters:
+        years (List[str]): entries such as "2020" or "2015-2020", invalid entries are ignored
+
+    Returns:
+        List[Tuple[int, int]]: the merged ranges, "2020" becomes (2020, 2020)
+    """
+    ranges = []
+    for year in years:
+        start, _, end = str(year).partition("-")
+        start, end = start.strip(), end.strip() or start.strip()
+        if start.isdigit() and end.isdigit():
+            ranges.append((min(int(start), int(end)), max(int(start), int(end))))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class YearRanges:
+    """
+    Membership test for a year in a set of merged ranges by binary search
+    """
+
+    def __init__(self, ranges: List[Tuple[int, int]]) -> None:
+        self.ranges = ranges
+        self._starts = [start for start, _ in ranges]
+
+    def __contains__(self, year: Optional[int]) -> bool:
+        if year is None:
+            return False
+        position = bisect_right(self._starts, year) - 1
+        return position >= 0 and year <= self.ranges[position][1]
+
+    def to_opensearch(self) -> dict:
+        return {
+            "bool": {
+                "should": [{"range": {"year": {"gte": start, "lte": end}}} for start, end in self.ranges],
+                "minimum_should_match": 1,
+            }
+        }
+
+
+class KeywordMatcher:
+    """
+    Match a set of keywords against a text in one regular expression scan
+
+    The keywords are combined into a single alternation, longest first, inside a lookahead so
+    that a match is tried at every position. A keyword contained in a longer keyword is implied
+    whenever the longer one is found, so overlapping keywords are all detected.
+    """
+
+    def __init__(self, keywords: List[str]) -> None:
+        self.keywords = sorted({keyword.strip().lower() for keyword in keywords if keyword.strip()}, key=lambda k: (-len(k), k))
+        self._pattern = re.compile("(?=(" + "|".join(re.escape(keyword) for keyword in self.keywords) + "))")
+        self._implied = {
+            keyword: frozenset(other for other in self.keywords if other in keyword)
+            for keyword in self.keywords
+        }
+
+    def any(self, text: str) -> bool:
+        if len(self.keywords) == 1:
+            return self.keywords[0] in text
+        return self._pattern.search(text) is not None
+
+    def all(self, text: str) -> bool:
+        if len(self.keywords) == 1:
+            return self.keywords[0] in text
+        found = set()
+        for match in self._pattern.finditer(text):
+            found |= self._implied[match.group(1)]
+            if len(found) == len(self.keywords):
+                return True
+        return False
+
+
+class CompiledFilter:
+    """
+    A filter spec compiled into a document predicate and an OpenSearch query
+
+    Attributes:
+        signature (str): the canonical JSON of the spec, equal for equal filters
+        clause (dict): the OpenSearch pre-filter, a superset of the matching documents, empty for none
+        exact (bool): whether the clause selects exactly the matching documents
+    """
+
+    def __init__(self, signature: str, predicates: List[Callable[[NormalizedDocument], bool]], clause: dict,
+                 exact: bool) -> None:
+        self.signature = signature
+        self.clause = clause
+        self.exact = exact
+        self._predicates = predicates
+
+    def is_empty(self) -> bool:
+        return not self._predicates
+
+    def matches(self, document: NormalizedDocument) -> bool:
+        return all(predicate(document) for predicate in self._predicates)
+
+    def apply(self, documents: List[Document]) -> List[Document]:
+        """
+        Keep the documents matching the filter, in their original order
+        """
+        if not self._predicates:
+            return documents
+        return [document for document in documents if self.matches(NormalizedDocument(document))]
+
+
+def normalize_spec(spec: dict) -> dict:
+    """
+    Canonicalize a filter spec: strip strings, drop empty entries and fields, sort lists
+
+    Parameters:
+        spec (dict): the filter spec, see the module docstring
+
+    Returns:
+        dict: the canonical spec, an empty dict for no filtering
+
+    Raises:
+        ValueError: if the spec contains an unknown field
+    """
+    unknown = set(spec) - set(LEAF_FIELDS) - set(GROUP_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {sorted(unknown)}")
+
+    normalized = {}
+    title = spec.get("title")
+    if isinstance(title, str) and title.strip():
+        normalized["title"] = title.strip()
+    for field in LEAF_FIELDS[1:]:
+        values = sorted({str(value).strip() for value in spec.get(field) or [] if str(value).strip()})
+        if values:
+            normalized[field] = values
+    for field in GROUP_FIELDS:
+        groups = [normalize_spec(group) for group in spec.get(field) or []]
+        # An empty sub-spec has no criteria and is ignored
+        groups = sorted((group for group in groups if group), key=lambda group: json.dumps(group, sort_keys=True))
+        if groups:
+            normalized[field] = groups
+    return normalized
+
+
+def _build(spec: dict) -> Tuple[List[Callable[[NormalizedDocument], bool]], dict, bool]:
+    """
+    Build the predicates, cheapest first, the OpenSearch pre-filter of a canonical spec and whether it is exact
+    """
+    predicates, filters, must_not = [], [], []
+    exact = True
+
+    if "years" in spec:
+        years = YearRanges(parse_year_ranges(spec["years"]))
+        if years.ranges:
+            predicates.append(lambda document: document.year in years)
+            filters.append(years.to_opensearch())
+    if "exclude_years" in spec:
+        excluded_years = YearRanges(parse_year_ranges(spec["exclude_years"]))
+        if excluded_years.ranges:
+            predicates.append(lambda document: document.year not in excluded_years)
+            must_not.append(excluded_years.to_opensearch())
+    if "title" in spec:
+        title = spec["title"].lower()
+        predicates.append(lambda document: title in document.title)
+        exact = False
+    if "keywords" in spec:
+        required = KeywordMatcher(spec["keywords"])
+        predicates.append(lambda document: required.all(document.text))
+        exact = False
+    if "any_keywords" in spec:
+        alternatives = KeywordMatcher(spec["any_keywords"])
+        predicates.append(lambda document: alternatives.any(document.text))
+        exact = False
+    if "exclude_keywords" in spec:
+        excluded = KeywordMatcher(spec["exclude_keywords"])
+        predicates.append(lambda document: not excluded.any(document.text))
+        must_not.extend(
+            {"match_phrase": {"chunk": keyword}} for keyword in spec["exclude_keywords"] if re.fullmatch(r"\w+", keyword)
+        )
+        exact = False
+
+    # Sub-specs without a valid criterion (e.g. only malformed years) are ignored like empty ones
+    options = [option for option in map(compile_filter, spec.get("any_of", [])) if not option.is_empty()]
+    if options:
+        predicates.append(lambda document: any(option.matches(document) for option in options))
+        # An option without pre-filter may match any document, and so may the alternative
+        if all(option.clause for option in options):
+            filters.append({"bool": {"should": [option.clause for option in options], "minimum_should_match": 1}})
+        exact = exact and all(option.exact for option in options)
+    exclusions = [exclusion for exclusion in map(compile_filter, spec.get("none_of", [])) if not exclusion.is_empty()]
+    if exclusions:
+        predicates.append(lambda document: not any(exclusion.matches(document) for exclusion in exclusions))
+        # Only exact sub-specs can be excluded in OpenSearch, a superset would drop matching documents
+        must_not.extend(exclusion.clause for exclusion in exclusions if exclusion.exact)
+        exact = exact and all(exclusion.exact for exclusion in exclusions)
+
+    clause = {}
+    if filters or must_not:
+        clause["bool"] = {}
+        if filters:
+            clause["bool"]["filter"] = filters
+        if must_not:
+            clause["bool"]["must_not"] = must_not
+    return predicates, clause, exact
+
+
+@lru_cache(maxsize=1024)
+def _compile_signature(signature: str) -> CompiledFilter:
+    predicates, clause, exact = _build(json.loads(signature))
+    return CompiledFilter(signature, predicates, clause, exact)
+
+
+def compile_filter(spec: dict) -> CompiledFilter:
+    """
+    Compile a filter spec, repeated specs reuse the compiled filter
+
+    Parameters:
+        spec (dict): the filter spec, see the module docstring
+
+    Returns:
+        CompiledFilter: the document predicate and OpenSearch pre-filter of the spec
+    """
+    return _compile_signature(json.dumps(normalize_spec(spec), sort_keys=True))
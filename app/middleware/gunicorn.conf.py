@@ -0,0 +1,53 @@
+"""
+Gunicorn settings to serve the middleware with several uvicorn worker processes
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is imported once in the master process and the AnglE weights are loaded there
+before the workers are forked, so all workers share the same memory pages (copy-on-write)
+instead of holding one copy of the model each. Every worker then builds its own RAG
+pipeline at startup; caches, metrics and stage limits are per worker.
+"""
+import gc
+import os
+
+from config import WEB_CONCURRENCY, PRELOAD_EMBEDDING_MODEL
+from config import EMBEDDING_BACKEND, EMBEDDING_DEVICE, EMBEDDING_QUANTIZE, EMBEDDING_NUM_THREADS
+
+bind = "0.0.0.0:8000"
+workers = WEB_CONCURRENCY
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import main in the master, the workers inherit the loaded modules
+preload_app = True
+
+# Pipeline initialization runs in a background thread, but the first LLM calls can be slow
+timeout = 120
+graceful_timeout = 30
+
+
+def on_starting(server):
+    if not PRELOAD_EMBEDDING_MODEL or EMBEDDING_BACKEND != "angle":
+        return
+
+    import torch
+    from models import shared_angle
+
+    # CUDA cannot be used across fork, so each worker loads its own copy on the GPU
+    if EMBEDDING_DEVICE == "cuda" or (EMBEDDING_DEVICE == "auto" and torch.cuda.is_available()):
+        print("Embedding model runs on cuda, not preloading it before fork")
+        return
+
+    print("Loading the embedding model before forking the workers...")
+    shared_angle(text_type="query", device=EMBEDDING_DEVICE, quantize=EMBEDDING_QUANTIZE)
+
+    # Keep the garbage collector from touching (and so copying) the preloaded objects in the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import torch
+
+    # Split the cores between the workers instead of every worker using all of them
+    threads = EMBEDDING_NUM_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(threads)
@@ -0,0 +1,196 @@
+"""
+Local LLM backends: a quantized GGUF model run by llama.cpp, in-process or as a sidecar server
+
+In-process (LLM_MODEL=llamacpp) needs llama-cpp-python and generates one answer at a time
+per worker, config.py clamps STAGE_LIMIT_LLM to 1. The sidecar (LLM_MODEL=llamacpp-server) is
+the llama.cpp server started with --parallel and --cont-batching: concurrent generations share
+its decoding batches, STAGE_LIMIT_LLM defaults to its number of parallel slots (LLAMA_PARALLEL).
+
+Both reuse the key/value state of the static prompt prefix (the RAG instructions before the
+question) so only the question and context are processed for each answer: in-process the
+pre-filled state is kept per model and prompt version, the server keeps it per slot.
+"""
+import json
+import threading
+from typing import Any, Iterator, List, Optional
+
+import requests
+from langchain_community.llms import LlamaCpp
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+from metrics import cache_events
+
+# Keep-alive connections to the sidecar, shared by all generations of the process
+_session = requests.Session()
+
+# Tokens and pre-filled llama.cpp state of the static prompt prefix, by (model path, prompt version)
+_prefix_states = {}
+
+# One generation at a time on the in-process model, its key/value cache is a single sequence.
+# A semaphore, not a lock: a streamed generation is resumed on whichever thread pulls the next
+# token, so the thread releasing it may not be the one that acquired it
+_generation_slot = threading.Semaphore(1)
+
+
+class PrefixCachedLlamaCpp(LlamaCpp):
+    """
+    LlamaCpp that keeps the static prompt prefix in the key/value cache before each generation
+
+    llama.cpp skips the prompt tokens already in its key/value cache. After a RAG prompt the
+    prefix is still there; after any other prompt its pre-filled state is restored, so only the
+    tokens following the prefix are evaluated, whatever the previous generation was.
+
+    Attributes:
+        prompt_prefix (str): the rendered prompt text shared by all generations, empty to disable
+        prompt_version (str): identifies the prompt, part of the cache key with the model path
+    """
+
+    prompt_prefix: str = ""
+    prompt_version: str = ""
+
+    def warm_prefix(self) -> None:
+        """
+        Pre-fill the static prompt prefix, so the first answer does not pay for it
+        """
+        with _generation_slot:
+            # Any text after the prefix, so that its last token is tokenized as in a real prompt
+            self._restore_prefix(self.prompt_prefix + " What")
+
+    def _restore_prefix(self, prompt: str) -> None:
+        if not self.prompt_prefix or not prompt.startswith(self.prompt_prefix):
+            return
+        key = (self.model_path, self.prompt_version)
+        if key in _prefix_states:
+            tokens, state = _prefix_states[key]
+            # llama.cpp already reuses the prefix when the last prompt started with it (e.g. a RAG prompt),
+            # the state is only copied back when another prompt replaced it
+            if self.client.n_tokens >= len(tokens) and list(self.client._input_ids[:len(tokens)]) == tokens:
+                cache_events.inc(cache="prompt_prefix", result="hit")
+                return
+            self.client.load_state(state)
+            cache_events.inc(cache="prompt_prefix", result="restored")
+            return
+        # Tokens at the end of the prefix may merge with the text that follows it, only the tokens
+        # shared with the tokenization of an actual prompt are pre-filled
+        tokens = self.client.tokenize(self.prompt_prefix.encode("utf-8"))
+        prompt_tokens = self.client.tokenize(prompt.encode("utf-8"))
+        shared = 0
+        while shared < min(len(tokens), len(prompt_tokens)) and tokens[shared] == prompt_tokens[shared]:
+            shared += 1
+        tokens = tokens[:shared]
+        self.client.reset()
+        self.client.eval(tokens)
+        _prefix_states[key] = (list(tokens), self.client.save_state())
+        cache_events.inc(cache="prompt_prefix", result="miss")
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        with _generation_slot:
+            self._restore_prefix(prompt)
+            return super()._call(prompt, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        _generation_slot.acquire()
+        try:
+            self._restore_prefix(prompt)
+            yield from super()._stream(prompt, stop=stop, run_manager=run_manager, **kwargs)
+        finally:
+            # Also runs when the client disconnects and the generator is closed
+            _generation_slot.release()
+
+
+def llama_cpp_model(model_path: str, max_tokens: int = 256, threads: int = 0, context_size: int = 2048,
+                    prompt_prefix: str = "", prompt_version: str = ""):
+    """
+    Load a quantized GGUF model in-process with llama.cpp
+
+    Parameters:
+        model_path (str): the GGUF file, e.g. a Q4_K_M quantized instruct model
+        max_tokens (int): the maximum number of generated tokens per answer
+        threads (int): the number of generation threads, 0 uses all cores
+        context_size (int): the context window in tokens, prompt and answer included
+        prompt_prefix (str): the static prompt prefix to pre-fill once and reuse, empty to disable
+        prompt_version (str): the version of the prompt the prefix comes from
+
+    Returns:
+        PrefixCachedLlamaCpp: LangChain LLM object
+    """
+    # llama-cpp-python is only needed for this backend, it is imported when the model is loaded
+    return PrefixCachedLlamaCpp(
+        model_path=model_path,
+        prompt_prefix=prompt_prefix,
+        prompt_version=prompt_version,
+        # Answers are generated in one call, _call restores the prefix and does not go through _stream
+        streaming=False,
+        max_tokens=max_tokens,
+        n_threads=threads or None,
+        n_ctx=context_size,
+        temperature=0.01,
+        top_p=1,
+        verbose=False,
+    )
+
+
+class LlamaServerLLM(LLM):
+    """
+    LLM served by a llama.cpp server sidecar through its /completion API
+
+    Attributes:
+        base_url (str): the URL of the server, e.g. http://llama:8080
+        max_tokens (int): the maximum number of generated tokens per answer
+        temperature (float): the sampling temperature
+        timeout (float): the timeout of a generation in seconds
+        prompt_prefix (str): the static prompt prefix, kept in the key/value cache of the slots
+    """
+
+    base_url: str = "http://llama:8080"
+    max_tokens: int = 256
+    temperature: float = 0.01
+    timeout: float = 120.0
+    prompt_prefix: str = ""
+
+    def warm_prefix(self) -> None:
+        """
+        Pre-fill the static prompt prefix in a slot of the server without generating
+        """
+        if not self.prompt_prefix:
+            return
+        payload = {**self._payload(self.prompt_prefix, None, False), "n_predict": 0}
+        _session.post(f"{self.base_url}/completion", json=payload, timeout=self.timeout).raise_for_status()
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama-cpp-server"
+
+    def _payload(self, prompt: str, stop: Optional[List[str]], stream: bool) -> dict:
+        return {
+            "prompt": prompt,
+            "n_predict": self.max_tokens,
+            "temperature": self.temperature,
+            "stop": stop or [],
+            "stream": stream,
+            # The slot keeps the key/value cache of its last prompt and only evaluates what differs,
+            # so the shared instructions are not processed again
+            "cache_prompt": bool(self.prompt_prefix),
+        }
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        response = _session.post(f"{self.base_url}/completion", json=self._payload(prompt, stop, False), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["content"]
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        with _session.post(f"{self.base_url}/completion", json=self._payload(prompt, stop, True),
+                           timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            # Server-sent events, one "data: {...}" line per generated token
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = json.loads(line[len(b"data: "):])
+                if data.get("content"):
+                    yield GenerationChunk(text=data["content"])
+                if data.get("stop"):
+                    break
@@ -0,0 +1,281 @@
+import json
+import math
+import os
+import re
+import sys
+import uuid
+from typing import Any, Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from search import knn_query, hits_to_documents
+
+# Files written by build_local_index and memory-mapped by LocalVectorStore
+EMBEDDINGS_FILE = "embeddings.npy"
+NORMS_FILE = "norms.npy"
+METADATA_FILE = "metadata.jsonl"
+INFO_FILE = "info.json"
+HNSW_FILE = "hnsw.bin"
+
+# Metadata columns of data_embedding.py kept in the sidecar, same fields as the OpenSearch index
+METADATA_COLUMNS = ["pmid", "title", "chunk_id", "chunk", "year", "month"]
+
+# With the HNSW graph, filters allowing at most this many chunks are searched exactly over the
+# allowed chunks: a graph search cannot return more hits than allowed chunks and gets slow and
+# inaccurate on narrow filters
+EXACT_SEARCH_LIMIT = 10000
+
+
+def build_local_index(source_file: str, destination_folder: str, hnsw: bool = False) -> None:
+    """
+    Convert the CSV produced by data_embedding.py into a memory-mappable local index
+
+    Parameters:
+        source_file (str): the CSV file with the chunks and their embeddings
+        destination_folder (str): the folder where the index files are written
+        hnsw (bool): also build an HNSW graph (requires hnswlib) for large corpora
+    """
+    # pandas is only needed to build the index, not to serve it
+    import pandas as pd
+
+    df = pd.read_csv(source_file)
+    embeddings = np.array([json.loads(embedding) for embedding in df["embedding"]], dtype=np.float32)
+    write_local_index(df, embeddings, destination_folder, hnsw=hnsw)
+
+
+def write_local_index(df, embeddings: np.ndarray, destination_folder: str, hnsw: bool = False) -> None:
+    """
+    Write the chunks and their embeddings as a memory-mappable local index
+
+    Parameters:
+        df (pandas.DataFrame): the chunks with the METADATA_COLUMNS
+        embeddings (np.ndarray): one float32 embedding per chunk
+        destination_folder (str): the folder where the index files are written
+        hnsw (bool): also build an HNSW graph (requires hnswlib) for large corpora
+    """
+    os.makedirs(destination_folder, exist_ok=True)
+    np.save(os.path.join(destination_folder, EMBEDDINGS_FILE), embeddings)
+    np.save(os.path.join(destination_folder, NORMS_FILE), np.sum(embeddings * embeddings, axis=1))
+
+    with open(os.path.join(destination_folder, METADATA_FILE), "w") as file:
+        for row in df[METADATA_COLUMNS].itertuples(index=False):
+            metadata = {column: value for column, value in zip(METADATA_COLUMNS, row)}
+            metadata["pmid"] = int(metadata["pmid"])
+            metadata["chunk_id"] = int(metadata["chunk_id"])
+            file.write(json.dumps(metadata, default=str) + "\n")
+
+    with open(os.path.join(destination_folder, INFO_FILE), "w") as file:
+        json.dump({"uuid": uuid.uuid4().hex, "count": len(df), "dimension": embeddings.shape[1]}, file)
+
+    if hnsw:
+        import hnswlib
+
+        graph = hnswlib.Index(space="l2", dim=embeddings.shape[1])
+        graph.init_index(max_elements=len(embeddings), ef_construction=200, M=16)
+        graph.add_items(embeddings, np.arange(len(embeddings)))
+        graph.save_index(os.path.join(destination_folder, HNSW_FILE))
+
+
+class LocalIndex:
+    """
+    In-process stand-in for the OpenSearch client of a single index
+
+    Implements the subset of the client API used by the middleware: search and
+    msearch with the k-NN bodies of search.knn_query and the lexical bodies of
+    search.bm25_query (including the filters of RetrievalFilter.to_opensearch_filter),
+    count and indices.get_settings. k-NN scores follow the lucene l2 space of the
+    OpenSearch index: 1 / (1 + distance^2). Lexical scores are BM25 over substring
+    counts of the query words in the lowered chunk and title, an approximation of
+    the analyzed OpenSearch fields.
+
+    Attributes:
+        embeddings (np.memmap): the read-only, memory-mapped embedding matrix
+        metadata (List[dict]): the source fields of each chunk
+        graph: the optional hnswlib graph, None for exact search
+    """
+
+    def __init__(self, folder: str, hnsw: bool = False, ef_search: int = 100) -> None:
+        self.embeddings = np.load(os.path.join(folder, EMBEDDINGS_FILE), mmap_mode="r")
+        self.norms = np.load(os.path.join(folder, NORMS_FILE), mmap_mode="r")
+        with open(os.path.join(folder, METADATA_FILE)) as file:
+            self.metadata = [json.loads(line) for line in file]
+        with open(os.path.join(folder, INFO_FILE)) as file:
+            self.info = json.load(file)
+
+        # Normalized metadata for vectorized filtering
+        self._years = np.array([_to_year(metadata["year"]) for metadata in self.metadata])
+        self._lower = {
+            field: np.array([str(metadata[field]).lower() for metadata in self.metadata])
+            for field in ("title", "chunk")
+        }
+        # Lengths in words of the lowered fields, for the BM25 length normalization
+        self._lengths = {field: np.char.count(values, " ") + 1 for field, values in self._lower.items()}
+
+        self.graph = None
+        if hnsw:
+            import hnswlib
+
+            self.graph = hnswlib.Index(space="l2", dim=self.embeddings.shape[1])
+            self.graph.load_index(os.path.join(folder, HNSW_FILE), max_elements=len(self.metadata))
+            self.graph.set_ef(ef_search)
+
+        self.indices = _LocalIndices(self)
+
+    def _mask(self, clause: dict) -> np.ndarray:
+        """
+        Evaluate a filter clause into a boolean mask over all chunks
+        """
+        if "bool" in clause:
+            mask = np.ones(len(self.metadata), dtype=bool)
+            for sub_clause in clause["bool"].get("filter", []) + clause["bool"].get("must", []):
+                mask &= self._mask(sub_clause)
+            for sub_clause in clause["bool"].get("must_not", []):
+                mask &= ~self._mask(sub_clause)
+            should = clause["bool"].get("should", [])
+            if should:
+                mask &= np.any([self._mask(sub_clause) for sub_clause in should], axis=0)
+            return mask
+        if "match_phrase" in clause:
+            (field, phrase), = clause["match_phrase"].items()
+            return np.char.find(self._lower[field], str(phrase).lower()) >= 0
+        if "range" in clause:
+            bounds = clause["range"]["year"]
+            return (self._years >= bounds.get("gte", -np.inf)) & (self._years <= bounds.get("lte", np.inf))
+        raise ValueError(f"Unsupported filter clause for the local index: {list(clause)}")
+
+    def _knn(self, vector: List[float], k: int, mask: Optional[np.ndarray]) -> List[tuple]:
+        query = np.asarray(vector, dtype=np.float32)
+        allowed = len(self.metadata) if mask is None else int(mask.sum())
+        k = min(k, allowed)
+        if k == 0:
+            return []
+
+        if self.graph is not None and (mask is None or allowed > EXACT_SEARCH_LIMIT):
+            allowed_filter = None if mask is None else (lambda position: bool(mask[position]))
+            try:
+                labels, distances = self.graph.knn_query(query, k=k, filter=allowed_filter)
+                return [(int(label), float(distance)) for label, distance in zip(labels[0], distances[0])]
+            except RuntimeError:
+                # The graph search found fewer than k allowed chunks, fall back to the exact search
+                pass
+
+        # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2, one matrix-vector product over the memory map,
+        # or over the allowed rows only (a copy of those rows) when filtering
+        if mask is None:
+            positions = None
+            distances = self.norms - 2 * (self.embeddings @ query) + float(query @ query)
+        else:
+            positions = np.flatnonzero(mask)
+            distances = self.norms[positions] - 2 * (self.embeddings[positions] @ query) + float(query @ query)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        if positions is not None:
+            return [(int(positions[position]), float(distances[position])) for position in top]
+        return [(int(position), float(distances[position])) for position in top]
+
+    def _bm25(self, text: str, fields: List[str], k: int, mask: Optional[np.ndarray],
+              k1: float = 1.2, b: float = 0.75) -> List[tuple]:
+        scores = np.zeros(len(self.metadata))
+        for field in fields:
+            values = self._lower[field]
+            lengths = self._lengths[field]
+            for term in set(re.findall(r"\w+", text.lower())):
+                frequencies = np.char.count(values, term)
+                matching = int(np.count_nonzero(frequencies))
+                if matching == 0:
+                    continue
+                idf = math.log(1 + (len(values) - matching + 0.5) / (matching + 0.5))
+                scores += idf * frequencies * (k1 + 1) / (frequencies + k1 * (1 - b + b * lengths / lengths.mean()))
+
+        matches = scores > 0 if mask is None else (scores > 0) & mask
+        positions = np.flatnonzero(matches)
+        k = min(k, len(positions))
+        if k == 0:
+            return []
+        top = positions[np.argpartition(-scores[positions], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(position), float(scores[position])) for position in top]
+
+    def search(self, index: str = None, body: dict = None, **kwargs) -> dict:
+        query = body.get("query", {})
+        if "knn" in query:
+            (_, knn), = query["knn"].items()
+            mask = self._mask(knn["filter"]) if knn.get("filter") else None
+            scored = [
+                (position, 1.0 / (1.0 + max(distance, 0.0)))
+                for position, distance in self._knn(knn["vector"], body.get("size", knn["k"]), mask)
+            ]
+        elif "bool" in query and query["bool"].get("must") and "multi_match" in query["bool"]["must"][0]:
+            match = query["bool"]["must"][0]["multi_match"]
+            filters = query["bool"].get("filter", [])
+            mask = self._mask({"bool": {"filter": filters}}) if filters else None
+            scored = self._bm25(match["query"], match["fields"], body.get("size", 10), mask)
+        else:
+            raise ValueError("The local index only supports k-NN and BM25 queries")
+
+        hits = [
+            {"_id": str(position), "_score": score, "_source": self.metadata[position]}
+            for position, score in scored
+        ]
+        return {"hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+    def msearch(self, body: List[dict] = None, index: str = None, **kwargs) -> dict:
+        return {"responses": [self.search(body=query) for query in body[1::2]]}
+
+    def count(self, index: str = None, **kwargs) -> dict:
+        return {"count": len(self.metadata)}
+
+
+class _LocalIndices:
+    def __init__(self, local_index: LocalIndex) -> None:
+        self._local_index = local_index
+
+    def get_settings(self, index: str = None, **kwargs) -> dict:
+        return {index: {"settings": {"index": {"uuid": self._local_index.info["uuid"]}}}}
+
+
+def _to_year(year) -> float:
+    try:
+        return float(year)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class LocalVectorStore(VectorStore):
+    """
+    A read-only LangChain vector store over a LocalIndex
+
+    It exposes the same client, index_name and embedding_function attributes as
+    OpenSearchVectorSearch, so VariableRetriever works with either backend.
+    """
+
+    def __init__(self, folder: str, embedding_function: Embeddings, index_name: str = "local",
+                 hnsw: bool = False) -> None:
+        self.client = LocalIndex(folder, hnsw=hnsw)
+        self.index_name = index_name
+        self.embedding_function = embedding_function
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        body = knn_query(self.embedding_function.embed_query(query), k=k, efficient_filter=kwargs.get("efficient_filter"))
+        return hits_to_documents(self.client.search(body=body)["hits"]["hits"])
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise NotImplementedError("The local index is built from data_embedding.py output with build_local_index")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "LocalVectorStore":
+        raise NotImplementedError("The local index is built from data_embedding.py output with build_local_index")
+
+
+if __name__ == "__main__":
+
+    # Usage: python local_store.py <data_embeddings.csv> <destination folder> [--hnsw]
+    build_local_index(sys.argv[1], sys.argv[2], hnsw="--hnsw" in sys.argv)
@@ -1,23 +1,66 @@
-from fastapi import FastAPI, BackgroundTasks
+import asyncio
+import contextvars
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import anyio
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from langchain.chains import RetrievalQA
-from langchain import hub
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from langchain.chains.question_answering import load_qa_chain
 
 from pydantic import BaseModel, Field
-from typing import List, Optional
-
-from utils import llm_model, opensearch_vector_store, build_references, processed_output
-from config import set_api_keys
-from models import VariableRetriever, RetrievalFilter
-
-rag_pipeline = None
+from typing import Iterator, List, Optional
+
+from utils import llm_model, vector_store, build_references, processed_output, os_client, embedding_drift, index_version
+from utils import sse_event, search_hit, encode_cursor, decode_cursor
+from config import set_api_keys, EMBEDDING_QUANTIZE, EMBEDDING_DRIFT_SAMPLES, INDEX_NAME
+from config import ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_INDEX_CHECK
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_TOKENIZER
+from config import VECTOR_STORE_BACKEND, RETRIEVAL_TOP_N, RERANK_MODEL, RERANK_BUDGET_MS, RERANK_CACHE_SIZE
+from config import WORKER_THREADS, WARMUP_QUERY, BATCH_MAX_QUESTIONS, BATCH_GENERATION_CONCURRENCY
+from config import STAGE_LIMIT_LLM, REQUEST_DEADLINE_S, BATCH_REQUEST_DEADLINE_S, LLM_MIN_TIME_S
+from config import SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from models import VariableRetriever, RetrievalFilter, batch_retrieve
+from cache import AnswerCache, normalize_query
+from concurrency import stage_limiter, llm_admission, Overloaded, SingleFlight
+from connections import pool_stats
+from prompts import RAG_PROMPT, PROMPT_VERSION
+from reranking import CrossEncoderReranker
+from context import pack_context, token_counter, approximate_token_count
+from metrics import registry, request_seconds, request_timings, timed_stage, server_timing_header, GaugeCallback
+from metrics import degraded_answers
+
+# Built once at startup and shared by all requests; the per-request
+# retriever (with its filter) is created in answer_question
+qa_chain = None
 vectore_store = None
 retriever = None
 prompt = None
 llm = None
+reranker = None
+count_tokens = approximate_token_count
+
+answer_cache = AnswerCache(max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity_threshold=ANSWER_CACHE_SIMILARITY)
+# Generations run here so that a request can stop waiting at its deadline, a generation
+# holds its admission slot until it finishes
+generation_pool = ThreadPoolExecutor(max_workers=STAGE_LIMIT_LLM, thread_name_prefix="generation")
 
-filtering = False
+# Status of an answer whose generation was skipped, and the message shown instead
+NO_ANSWER_STATUS = "no_generated_answer"
+NO_ANSWER_MESSAGE = "The server is busy and could not generate an answer in time, please see the references."
 
+# Concurrent identical questions share one run of the pipeline
+answer_flights = SingleFlight("answer")
+current_index_version = ""
+index_version_checked_at = 0.0
+
+
+DEFAULT_FILTER = {"title": "", "years": [], "keywords": []}
 
 
 # Initialize FastAPI instance
@@ -28,6 +71,9 @@ INITIALIZING = False
 SERVER_STATUS_MESSAGE = "Initializing FastAPI..."
 SERVER_STATUS = "NOK"
 
+# Status and load time in seconds of each pipeline component, reported by /health/ready
+COMPONENTS = {name: {"status": "pending", "load_time": None} for name in ["llm", "vector_store", "prompt", "reranker", "warmup"]}
+
 # Allow all origins during development
 origins = ["*"]
 
@@ -37,96 +83,457 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-def initialization_task():
-    initialize_rag_pipeline()
-
-@app.get("/server_status")
-def server_status(background_tasks: BackgroundTasks):
 
+@app.middleware("http")
+async def record_request_timings(request: Request, call_next):
+    """
+    Time every request and report its stage timings in a Server-Timing header
+    """
+    # The stages running in the worker pool append to this list through the context variable
+    timings = []
+    token = request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    elapsed = time.perf_counter() - started
+    # The route template, not the raw path: unknown URLs must not create a series each
+    route = request.scope.get("route")
+    request_seconds.observe(elapsed, endpoint=route.path if route is not None else "unmatched")
+
+    timings.append(("total", elapsed))
+    response.headers["Server-Timing"] = server_timing_header(timings)
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+
+def _cache_sizes() -> dict:
+    sizes = {(("cache", "answer"),): answer_cache.stats()["size"]}
+    if vectore_store is not None and getattr(vectore_store.embedding_function, "cache", None) is not None:
+        sizes[(("cache", "embedding"),)] = vectore_store.embedding_function.cache.stats()["size"]
+    if reranker is not None:
+        sizes[(("cache", "rerank_scores"),)] = reranker.cache.stats()["size"]
+    return sizes
+
+
+def _stage_queues() -> dict:
+    series = {}
+    for stage, stats in stage_status().items():
+        series[(("stage", stage), ("state", "active"))] = stats["active"]
+        series[(("stage", stage), ("state", "waiting"))] = stats["waiting"]
+    batcher = getattr(vectore_store.embedding_function, "batcher", None) if vectore_store is not None else None
+    if batcher is not None:
+        series[(("stage", "embedding_batch"), ("state", "waiting"))] = batcher.queue_depth()
+    return series
+
+
+def _pool_usage() -> dict:
+    stats = pool_stats()
+    series = {(("state", "active_calls"),): stats["active"]}
+    for pool in stats["pools"]:
+        series[(("state", "in_use"), ("host", pool["host"]))] = pool["in_use"]
+        series[(("state", "max_size"), ("host", pool["host"]))] = pool["max_size"]
+    return series
+
+
+registry.register(GaugeCallback("rag_cache_entries", "Entries held by each cache", _cache_sizes))
+registry.register(GaugeCallback("rag_stage_queue_depth", "Active and waiting calls of each pipeline stage", _stage_queues))
+registry.register(GaugeCallback("rag_inflight_questions", "Distinct questions being answered", lambda: {(): answer_flights.stats()["in_flight"]}))
+registry.register(GaugeCallback("rag_opensearch_pool", "Utilization of the shared OpenSearch connection pool", _pool_usage))
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    # Blocking pipeline calls run in this pool, requests beyond its size queue up
+    anyio.to_thread.current_default_thread_limiter().total_tokens = WORKER_THREADS
+
+
+@app.on_event("startup")
+def start_initialization():
+    """
+    Start initializing the RAG pipeline at process boot instead of on the first status poll
+    """
     global INITIALIZING
     if not INITIALIZING:
         INITIALIZING = True
         print("initializing...")
-        background_tasks.add_task(initialization_task)
+        threading.Thread(target=initialize_rag_pipeline, name="rag-initialization", daemon=True).start()
+
 
+@app.get("/server_status")
+def server_status():
     print("***Server status: ", SERVER_STATUS, " - ", SERVER_STATUS_MESSAGE)
     return {"serverMessage": SERVER_STATUS_MESSAGE, "serverStatus": SERVER_STATUS}
 
+
+@app.get("/health/live")
+def health_live():
+    """
+    Liveness probe: the process is up and serving requests
+    """
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def health_ready(response: Response):
+    """
+    Readiness probe: every component is loaded and the warm-up query succeeded
+    """
+    if SERVER_STATUS != "OK":
+        response.status_code = 503
+    return {"status": SERVER_STATUS, "message": SERVER_STATUS_MESSAGE, "components": COMPONENTS}
+
+
+def load_component(name: str, loader):
+    """
+    Load a pipeline component and record its status and load time
+
+    Parameters:
+        name (str): the name of the component as reported by /health/ready
+        loader (Callable): a function without arguments returning the component
+
+    Returns:
+        the loaded component
+    """
+    COMPONENTS[name] = {"status": "loading", "load_time": None}
+    started = time.perf_counter()
+    try:
+        component = loader()
+    except Exception as error:
+        COMPONENTS[name] = {"status": "failed", "load_time": None, "error": str(error)}
+        raise
+    COMPONENTS[name] = {"status": "ready", "load_time": round(time.perf_counter() - started, 3)}
+    return component
+
+
+def load_reranker():
+    """
+    Load the cross-encoder reranker when RERANK_MODEL is set, reranking is disabled otherwise
+    """
+    if not RERANK_MODEL:
+        return None
+    return CrossEncoderReranker(RERANK_MODEL, budget_ms=RERANK_BUDGET_MS, cache_size=RERANK_CACHE_SIZE)
+
+
+def warm_up():
+    """
+    Run a retrieval for a fixed query so the first user request does not pay for lazy initialization
+    """
+    warmup_retriever = make_retriever(RetrievalFilter(DEFAULT_FILTER))
+    warmup_retriever.get_relevant_documents(WARMUP_QUERY)
+
+    # Local LLM backends pre-fill the static prompt prefix once
+    if hasattr(llm, "warm_prefix"):
+        llm.warm_prefix()
+
+
 def initialize_rag_pipeline():
+    global SERVER_STATUS_MESSAGE
+    global SERVER_STATUS
+
+    try:
+        build_rag_pipeline()
+    except Exception as error:
+        SERVER_STATUS_MESSAGE = f"Initialization failed: {error}"
+        SERVER_STATUS = "NOK"
+        raise
+
+
+def build_rag_pipeline():
 
     # Define as global variables so that 
     # they can be accessed by server_status
     global SERVER_STATUS_MESSAGE
     global SERVER_STATUS
-    global rag_pipeline 
+    global qa_chain
     global vectore_store 
     global retriever 
     global prompt
     global llm
+    global reranker
+    global count_tokens
 
     # Setup all API tokens
     SERVER_STATUS_MESSAGE = "Setting up API keys..."
     SERVER_STATUS = "NOK"
     set_api_keys()
 
-    # Initialize LLM model
-    SERVER_STATUS_MESSAGE = "Initializing LLM model..."
+    # The LLM, the embedding model with the vector store and the
+    # (locally vendored) RAG prompt do not depend on each other
+    SERVER_STATUS_MESSAGE = "Initializing LLM model and Opensearch backend..."
     SERVER_STATUS = "NOK"
-    llm = llm_model()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        llm_future = executor.submit(load_component, "llm", llm_model)
+        store_future = executor.submit(load_component, "vector_store", lambda: vector_store(index_name=INDEX_NAME))
+        prompt_future = executor.submit(load_component, "prompt", lambda: RAG_PROMPT)
+        reranker_future = executor.submit(load_component, "reranker", load_reranker)
+        tokenizer_future = executor.submit(token_counter, CONTEXT_TOKENIZER)
+        llm = llm_future.result()
+        vectore_store = store_future.result()
+        prompt = prompt_future.result()
+        reranker = reranker_future.result()
+        count_tokens = tokenizer_future.result()
+
+    retriever = vectore_store.as_retriever(search_kwargs={"k": 20, "text_field":"chunk", "vector_field":"embedding"})
+
+    # Report the accuracy cost of the int8 weights against the stored fp32 embeddings
+    if EMBEDDING_QUANTIZE and EMBEDDING_DRIFT_SAMPLES > 0 and VECTOR_STORE_BACKEND == "opensearch":
+        drift = embedding_drift(vectore_store.embedding_function, os_client(), INDEX_NAME, EMBEDDING_DRIFT_SAMPLES)
+        print(f"Embedding drift against {INDEX_NAME}: ", drift)
 
-    # Initialize OpenSearch vector and store and retriever
-    SERVER_STATUS_MESSAGE = "Initializing Opensearch backend..."
+    SERVER_STATUS_MESSAGE = "Setting up RAG pipeline..."
     SERVER_STATUS = "NOK"
-    vector_store = opensearch_vector_store(index_name="pubmed_500_100")
-    retriever = vector_store.as_retriever(search_kwargs={"k": 20, "text_field":"chunk", "vector_field":"embedding"})
-    default_filter = {"title": "", "years": [], "keywords": []}
-    print(default_filter)
-    default_retriever = VariableRetriever(vectorstore=retriever, retrieval_filter=RetrievalFilter(default_filter))
+    # Initialize the langChain "stuff" chain once, retrievers are request-scoped
+    qa_chain = load_qa_chain(llm=llm, chain_type="stuff", prompt=prompt, verbose=True)
 
-    # Loads the latest version of RAG prompt
-    SERVER_STATUS_MESSAGE = "Setting up RAG pipeline..."
+    SERVER_STATUS_MESSAGE = "Warming up..."
     SERVER_STATUS = "NOK"
-    prompt = hub.pull("rlm/rag-prompt", api_url="https://api.hub.langchain.com")
-
-    # Initialize langChain RAG pipeline
-    rag_pipeline = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=default_retriever,
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": prompt, "verbose":"True"},
-        verbose=True    
-    )
+    load_component("warmup", warm_up)
 
     SERVER_STATUS_MESSAGE = "Setup finished!"
     SERVER_STATUS = "OK"
 
-def reinitialize_rag_pipeline_retriever(filter_dict: dict):
 
-    global SERVER_STATUS_MESSAGE
-    global SERVER_STATUS
-    global rag_pipeline
-    
-    filter_retriever = VariableRetriever(vectorstore=retriever, retrieval_filter=RetrievalFilter(filter_dict))
+def make_retriever(retrieval_filter: RetrievalFilter, search_mode: str = "dense") -> VariableRetriever:
+    """
+    Create the request-scoped retriever over the shared vector store and reranker
 
-    # Loads the latest version of RAG prompt
-    SERVER_STATUS_MESSAGE = "Setting up RAG pipeline..."
-    SERVER_STATUS = "NOK"
+    Parameters:
+        retrieval_filter (RetrievalFilter): the filter of the request
+        search_mode (str): dense, bm25 or hybrid retrieval
 
-    # Initialize langChain RAG pipeline
-    rag_pipeline = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=filter_retriever,
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": prompt, "verbose":"True"},
-        verbose=True    
+    Returns:
+        VariableRetriever: the retriever for this request
+    """
+    return VariableRetriever(
+        vectorstore=retriever, retrieval_filter=retrieval_filter, search_mode=search_mode,
+        reranker=reranker, top_n=RETRIEVAL_TOP_N,
     )
 
-    SERVER_STATUS_MESSAGE = "Setup finished!"
-    SERVER_STATUS = "OK"
+
+def answer_question(query_str: str, retrieval_filter: RetrievalFilter, search_mode: str = "dense",
+                    deadline: Optional[float] = None, lane: str = "interactive") -> dict:
+    """
+    Run the RAG pipeline for a single question with a request-scoped retriever
+
+    Parameters:
+        query_str (str): the question asked by the user
+        retrieval_filter (RetrievalFilter): the filter to apply to the retrieved documents
+        search_mode (str): dense, bm25 or hybrid retrieval
+        deadline (float): the time.monotonic() by which the answer is due, None waits for the LLM
+        lane (str): the admission lane of the generation, interactive or batch
+
+    Returns:
+        dict: the generated answer under "result" and the retrieved documents under "source_documents"
+    """
+    request_retriever = make_retriever(retrieval_filter, search_mode)
+    source_documents = request_retriever.get_relevant_documents(query_str)
+
+    return generate_answer(query_str, source_documents, deadline, lane)
+
+
+def no_answer(source_documents: list, reason: str) -> dict:
+    """
+    The answer of a request whose generation was skipped: its references only
+    """
+    print(f"No generated answer: {reason}")
+    degraded_answers.inc(reason=reason)
+    return {"result": "", "source_documents": source_documents, "status": NO_ANSWER_STATUS, "reason": reason}
+
+
+def remaining_time(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def run_generation(context_documents: list, query_str: str) -> dict:
+    try:
+        with timed_stage("llm"):
+            return qa_chain.invoke({"input_documents": context_documents, "question": query_str})
+    finally:
+        llm_admission.release()
+
+
+def generate_answer(query_str: str, source_documents: list, deadline: Optional[float] = None,
+                    lane: str = "interactive") -> dict:
+    """
+    Generate the answer to a question from already retrieved documents
+
+    The generation waits in the admission queue of its lane. When the queue is full, or the
+    deadline leaves less than LLM_MIN_TIME_S for the generation, the references are returned
+    without an answer instead.
+
+    Parameters:
+        query_str (str): the question asked by the user
+        source_documents (List[Document]): the documents to use as context
+        deadline (float): the time.monotonic() by which the answer is due, None waits for the LLM
+        lane (str): the admission lane, interactive or batch
+
+    Returns:
+        dict: the generated answer under "result", the retrieved documents under "source_documents"
+        and the status, "ok" or NO_ANSWER_STATUS
+    """
+    # Overlapping chunks are merged and repeated sentences dropped to keep the prompt short
+    with timed_stage("prompt_build"):
+        context_documents = pack_context(source_documents, CONTEXT_TOKEN_BUDGET, count_tokens)
+
+    remaining = remaining_time(deadline)
+    if remaining is not None and remaining < LLM_MIN_TIME_S:
+        return no_answer(source_documents, "deadline")
+    try:
+        llm_admission.acquire(lane, None if deadline is None else deadline - LLM_MIN_TIME_S)
+    except Overloaded as error:
+        return no_answer(source_documents, error.reason)
+
+    # The context is copied so that the LLM timing reaches the Server-Timing header of the request
+    future = generation_pool.submit(contextvars.copy_context().run, run_generation, context_documents, query_str)
+    try:
+        result = future.result(timeout=remaining_time(deadline))
+    except TimeoutError:
+        return no_answer(source_documents, "deadline")
+
+    return {"result": result["output_text"], "source_documents": source_documents, "status": "ok"}
+
+
+def stream_answer(query_str: str, retrieval_filter: RetrievalFilter, deadline: Optional[float] = None) -> Iterator[str]:
+    """
+    Run the RAG pipeline for a single question and stream the result as server-sent events
+
+    The references are sent as soon as retrieval finishes, followed by the LLM tokens
+    as they are generated and a final event with the processed answer, its status and timings.
+    Generation stops at the deadline, with the status "truncated".
+
+    Parameters:
+        query_str (str): the question asked by the user
+        retrieval_filter (RetrievalFilter): the filter to apply to the retrieved documents
+        deadline (float): the time.monotonic() by which the answer is due, None waits for the LLM
+
+    Returns:
+        Iterator[str]: the encoded server-sent events
+    """
+    started = time.perf_counter()
+    request_retriever = make_retriever(retrieval_filter)
+    source_documents = request_retriever.get_relevant_documents(query_str)
+    retrieval_time = time.perf_counter() - started
+    yield sse_event("references", {"references": build_references(source_documents)})
+
+    # Same prompt as the "stuff" chain: the packed chunks joined by blank lines
+    with timed_stage("prompt_build"):
+        context_documents = pack_context(source_documents, CONTEXT_TOKEN_BUDGET, count_tokens)
+        context = "\n\n".join(doc.page_content for doc in context_documents)
+        prompt_text = prompt.format(context=context, question=query_str)
+
+    generated = ""
+    first_token_time = None
+    status = "ok"
+    try:
+        remaining = remaining_time(deadline)
+        if remaining is not None and remaining < LLM_MIN_TIME_S:
+            raise Overloaded("deadline")
+        llm_admission.acquire("interactive", None if deadline is None else deadline - LLM_MIN_TIME_S)
+    except Overloaded as error:
+        no_answer(source_documents, error.reason)
+        status = NO_ANSWER_STATUS
+    else:
+        try:
+            with timed_stage("llm"):
+                for token in llm.stream(prompt_text):
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter() - started
+                    generated += token
+                    yield sse_event("token", {"text": token})
+                    if deadline is not None and time.monotonic() > deadline:
+                        status = "truncated"
+                        break
+        finally:
+            llm_admission.release()
+
+    yield sse_event("done", {
+        "answer": processed_output(generated) if status != NO_ANSWER_STATUS else NO_ANSWER_MESSAGE,
+        "status": status,
+        "timing": {
+            "retrieval_ms": round(retrieval_time * 1000, 1),
+            "first_token_ms": round((first_token_time or 0) * 1000, 1),
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        },
+    })
+
+
+def refresh_index_version() -> str:
+    """
+    Check the index version at most every ANSWER_CACHE_INDEX_CHECK seconds
+    and drop all cached answers when the index was rebuilt, a failed check keeps the last known version
+
+    Returns:
+        str: the current index version
+    """
+    global current_index_version
+    global index_version_checked_at
+
+    if time.monotonic() - index_version_checked_at > ANSWER_CACHE_INDEX_CHECK:
+        index_version_checked_at = time.monotonic()
+        try:
+            version = index_version(retriever.vectorstore.client, INDEX_NAME)
+        except Exception as error:
+            # A failed check does not fail the request, the last known version is kept until the next check
+            print(f"---ANSWER CACHE: INDEX VERSION CHECK FAILED ({error}), KEEPING {current_index_version} ---")
+            return current_index_version
+        if version != current_index_version:
+            if current_index_version:
+                print("---ANSWER CACHE: INDEX CHANGED, INVALIDATING ---")
+            answer_cache.invalidate()
+            current_index_version = version
+    return current_index_version
+
+
+def cached_answer_question(query_str: str, filter_data: dict, search_mode: str = "dense",
+                           deadline: Optional[float] = None) -> dict:
+    """
+    Answer a question from the answer cache when possible, otherwise run the RAG pipeline
+
+    Parameters:
+        query_str (str): the question asked by the user
+        filter_data (dict): the title, years and keywords to filter the documents by
+        search_mode (str): dense, bm25 or hybrid retrieval
+        deadline (float): the time.monotonic() by which the answer is due, None waits for the LLM
+
+    Returns:
+        dict: the generated answer under "result" and the retrieved documents under "source_documents"
+    """
+    scope = (json.dumps(filter_data, sort_keys=True), search_mode, INDEX_NAME, refresh_index_version(), PROMPT_VERSION)
+
+    # Identical questions arriving while the first one is answered wait for its answer
+    # instead of embedding, searching and generating again
+    return answer_flights.run(
+        (normalize_query(query_str), scope),
+        lambda: lookup_or_answer_question(query_str, filter_data, search_mode, scope, deadline),
+    )
+
+
+def lookup_or_answer_question(query_str: str, filter_data: dict, search_mode: str, scope: tuple,
+                              deadline: Optional[float] = None) -> dict:
+    """
+    Look the question up in the answer cache (exact and semantic), otherwise answer and cache it
+    """
+    # Exact hits are answered without embedding the query
+    answer = answer_cache.lookup_exact(query_str, scope)
+    if answer is not None:
+        return answer
+
+    # The query embedding is cached, so retrieval does not compute it a second time.
+    # The lexical path never embeds the query, so it only uses exact matches
+    embedding = None
+    if search_mode != "bm25":
+        embedding = retriever.vectorstore.embedding_function.embed_query(query_str)
+        answer = answer_cache.lookup_similar(scope, embedding)
+    if answer is None:
+        answer = answer_question(query_str, RetrievalFilter(filter_data), search_mode, deadline)
+        # Answers degraded under load are not cached, the next request may get a generated one
+        if answer["status"] == "ok":
+            answer_cache.store(query_str, scope, answer, embedding)
+    return answer
 
 
 @app.get("/read_root")
@@ -137,54 +544,88 @@ def read_root(message: str):
 
 class Filter(BaseModel):
     title: Optional[str] = Field(None, description="The title to filter by")
-    years: Optional[List[str]] = Field(None, description="The range of years to filter by")
-    keywords: Optional[List[str]] = Field(None, description="The keywords to filter by")
+    years: Optional[List[str]] = Field(None, description="The years or \"start-end\" year ranges to filter by")
+    keywords: Optional[List[str]] = Field(None, description="The keywords that must all be included")
+    any_keywords: Optional[List[str]] = Field(None, description="Keywords of which at least one must be included")
+    exclude_years: Optional[List[str]] = Field(None, description="The years or year ranges to leave out")
+    exclude_keywords: Optional[List[str]] = Field(None, description="Keywords that must not be included")
+    any_of: Optional[List["Filter"]] = Field(None, description="Filters of which at least one must hold")
+    none_of: Optional[List["Filter"]] = Field(None, description="Filters of which none may hold")
 
 class RequestBody(BaseModel):
     filter: Filter
     query_str: str
 
-@app.post("/retrieve_documents_dense_f")
-async def retrieve_documents(body: RequestBody):
+class BatchQuestion(BaseModel):
+    query_str: str
+    filter: Optional[Filter] = Field(None, description="The filter for this question, none for no filtering")
+
+class BatchRequestBody(BaseModel):
+    questions: List[BatchQuestion]
+
+class SearchRequestBody(BaseModel):
+    query_str: str
+    filter: Optional[Filter] = Field(None, description="The filter of the hits, none for no filtering")
+    size: int = Field(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE, description="The number of hits per page")
+    cursor: Optional[str] = Field(None, description="The next_cursor of the previous page, none for the first page")
+    mode: str = Field("dense", description="dense, bm25 or hybrid retrieval")
+
+
+def format_message(answer: dict) -> str:
     """
-    A complete end-to-end RAG to answer user questions
+    Format an answer as the "<answer>_<references>" message expected by the frontend
     """
-    global filtering
+    with timed_stage("postprocess"):
+        if answer.get("status", "ok") == "ok":
+            output = processed_output(answer["result"])
+        else:
+            output = NO_ANSWER_MESSAGE
+        return output + "_" + build_references(answer["source_documents"])
 
-    filter = body.filter
-    query_str = body.query_str
+
+def request_deadline() -> float:
+    return time.monotonic() + REQUEST_DEADLINE_S
+
+
+def filter_to_dict(filter: Optional[Filter]) -> dict:
+    """
+    Convert the filter of a request into the dictionary expected by RetrievalFilter
+    """
+    if filter is None:
+        return dict(DEFAULT_FILTER)
     filter_data = {
         "title": str(filter.title) if filter.title else "",
         "years": [str(year) for year in filter.years] if filter.years else [],
         "keywords": [str(keyword) for keyword in filter.keywords] if filter.keywords else []
         }
+    # The extended fields are only set when used, so plain filters keep their cache scope
+    for field in ["any_keywords", "exclude_years", "exclude_keywords"]:
+        if getattr(filter, field):
+            filter_data[field] = [str(value) for value in getattr(filter, field)]
+    for field in ["any_of", "none_of"]:
+        if getattr(filter, field):
+            filter_data[field] = [filter_to_dict(group) for group in getattr(filter, field)]
+    return filter_data
+
+@app.post("/retrieve_documents_dense_f")
+async def retrieve_documents(body: RequestBody):
+    """
+    A complete end-to-end RAG to answer user questions
+    """
+    filter = body.filter
+    query_str = body.query_str
+    filter_data = filter_to_dict(filter)
     
     print("title: ", filter.title)
     print("years: ", filter.years)
     print("keywords: ", filter.keywords)
-   
-    # all values are empty -> no filtering
-    if all(not value for value in filter_data.values()):
-        print("---FILTERING: EVERYTHING IS EMPTY ---")
-        if not filtering:
-            print("---FILTERING: ALREADY DEFAULT ---")
-            # no need to reinitialize the retriever because 
-            # it is already the default retriever
-            answer = rag_pipeline.invoke({"query": query_str}) 
-        else:
-            print("---FILTERING: SETTING TO DEFAULT ---")
-            default_filter = {"title": "", "years": [], "keywords": []}
-            reinitialize_rag_pipeline_retriever(default_filter)
-            answer = rag_pipeline.invoke({"query": query_str}) 
-            filtering = False
-    else:
-        print("---FILTERING: SETTING TO CUSTOM ---")
-        reinitialize_rag_pipeline_retriever(filter_data)
-        answer = rag_pipeline.invoke({"query": query_str}) 
-        filtering = True
 
-    output = processed_output(answer["result"])
-    return {"message": output + "_" + build_references(answer["source_documents"])}
+    # The filter travels with the request, so concurrent filtered and
+    # unfiltered questions never share (or overwrite) a retriever. The pipeline
+    # blocks, so it runs in the worker pool and the event loop keeps serving requests
+    answer = await run_in_threadpool(cached_answer_question, query_str, filter_data, "dense", request_deadline())
+
+    return {"message": format_message(answer), "status": answer.get("status", "ok")}
 
 
 
@@ -194,13 +635,168 @@ async def retrieve_documents(query_str: str):
     """
     OLD implementation: A complete end-to-end RAG to answer user questions
     """
-    answer = rag_pipeline.invoke({"query": query_str})  
-    output = processed_output(answer["result"])
-    
-    return {"message": output + "_" + build_references(answer["source_documents"])}
+    answer = await run_in_threadpool(cached_answer_question, query_str, DEFAULT_FILTER, "dense", request_deadline())
+    return {"message": format_message(answer), "status": answer.get("status", "ok")}
+
+
+@app.post("/retrieve_documents_batch")
+async def retrieve_documents_batch(body: BatchRequestBody):
+    """
+    Answer a list of questions: one embedding batch, one _msearch and bounded concurrent generation
+    """
+    deadline = time.monotonic() + BATCH_REQUEST_DEADLINE_S
+    questions = body.questions
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+
+    retrievers = [
+        make_retriever(RetrievalFilter(filter_to_dict(question.filter)))
+        for question in questions
+    ]
+    queries = [question.query_str for question in questions]
+    documents = await run_in_threadpool(batch_retrieve, retrievers, queries)
+
+    semaphore = asyncio.Semaphore(BATCH_GENERATION_CONCURRENCY)
+
+    async def generate(query_str, source_documents):
+        async with semaphore:
+            # Batch generations queue behind the interactive requests
+            return await run_in_threadpool(generate_answer, query_str, source_documents, deadline, "batch")
+
+    answers = await asyncio.gather(*[generate(query, docs) for query, docs in zip(queries, documents)])
+
+    with timed_stage("postprocess"):
+        return {"answers": [
+            {
+                "query_str": query,
+                "answer": processed_output(answer["result"]) if answer["status"] == "ok" else NO_ANSWER_MESSAGE,
+                "references": build_references(answer["source_documents"]),
+                "status": answer["status"],
+            }
+            for query, answer in zip(queries, answers)
+        ]}
+
+
+@app.get("/retrieve_documents_dense_stream")
+def retrieve_documents_stream(query_str: str):
+    """
+    Streaming variant of the end-to-end RAG: references first, then the answer tokens
+    """
+    # The generator blocks, StreamingResponse iterates it in the worker pool
+    return StreamingResponse(
+        stream_answer(query_str, RetrievalFilter(DEFAULT_FILTER), request_deadline()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def search_documents(query_str: str, filter_data: dict, search_mode: str, size: int, cursor: Optional[str]) -> dict:
+    """
+    Retrieve one page of ranked chunks for a query, without reranking or generation
+
+    Parameters:
+        query_str (str): the search query
+        filter_data (dict): the filter of the hits
+        search_mode (str): dense, bm25 or hybrid retrieval
+        size (int): the number of hits per page
+        cursor (str): the cursor of the page, None for the first page
+
+    Returns:
+        dict: the hits of the page and the cursor of the next page (None on the last page)
+
+    Raises:
+        ValueError: if the cursor is malformed or belongs to another query
+    """
+    signature = hashlib.sha1(
+        json.dumps([normalize_query(query_str), filter_data, search_mode], sort_keys=True).encode()
+    ).hexdigest()[:16]
+    offset = decode_cursor(cursor, signature) if cursor else 0
+
+    # One extra hit tells whether there is a next page; the retriever widens k as needed
+    search_retriever = VariableRetriever(
+        vectorstore=retriever, retrieval_filter=RetrievalFilter(filter_data), search_mode=search_mode,
+        top_n=offset + size + 1,
+    )
+    documents = search_retriever.get_relevant_documents(query_str)
+
+    with timed_stage("postprocess"):
+        has_more = len(documents) > offset + size
+        return {
+            "hits": [search_hit(document) for document in documents[offset:offset + size]],
+            "next_cursor": encode_cursor(offset + size, signature) if has_more else None,
+        }
+
+
+async def run_search(query_str: str, filter_data: dict, search_mode: str, size: int, cursor: Optional[str]) -> dict:
+    if search_mode not in ("dense", "bm25", "hybrid"):
+        raise HTTPException(status_code=422, detail="mode must be dense, bm25 or hybrid")
+    try:
+        return await run_in_threadpool(search_documents, query_str, filter_data, search_mode, size, cursor)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+
+@app.post("/search")
+async def search(body: SearchRequestBody):
+    """
+    Retrieval only: ranked chunks with pmid, title, year, score and PubMed URL, paginated by cursor.
+    The LLM is never called
+    """
+    return await run_search(body.query_str, filter_to_dict(body.filter), body.mode, body.size, body.cursor)
+
+
+@app.get("/search")
+async def search_get(query_str: str, size: int = SEARCH_PAGE_SIZE, cursor: Optional[str] = None, mode: str = "dense"):
+    """
+    Unfiltered retrieval-only search for type-ahead and result browsing, see POST /search
+    """
+    if not 1 <= size <= SEARCH_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=422, detail=f"size must be between 1 and {SEARCH_MAX_PAGE_SIZE}")
+    return await run_search(query_str, dict(DEFAULT_FILTER), mode, size, cursor)
+
+
+@app.get("/stage_status")
+def stage_status():
+    """
+    Report the limit, active and waiting calls of each pipeline stage
+    """
+    stats = stage_limiter.stats()
+    stats["llm"] = llm_admission.stats()
+    return stats
+
+
+@app.get("/pool_status")
+def pool_status():
+    """
+    Report the utilization of the shared OpenSearch connection pool
+    """
+    return pool_stats()
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Report per-stage latency histograms, cache counters and queue depths in the Prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/invalidate_cache")
+def invalidate_cache():
+    """
+    Drop all cached answers, e.g. after re-uploading documents to the index
+    """
+    answer_cache.invalidate()
+    return {"message": "Answer cache invalidated"}
 
 
 @app.get("/retrieve_documents_sparse")
-def retrieve_documents_sparse(message: str):
-    response_message = f"FastAPI detected, that you said: {message}"
-    return {"message": response_message}
+async def retrieve_documents_sparse(query_str: str, mode: str = "bm25"):
+    """
+    End-to-end RAG with lexical retrieval: BM25 only (mode=bm25) or BM25 and k-NN merged by rank fusion (mode=hybrid)
+    """
+    if mode not in ("bm25", "hybrid"):
+        raise HTTPException(status_code=422, detail="mode must be bm25 or hybrid")
+
+    answer = await run_in_threadpool(cached_answer_question, query_str, DEFAULT_FILTER, mode, request_deadline())
+    return {"message": format_message(answer), "status": answer.get("status", "ok")}
@@ -0,0 +1,170 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Tuple
+
+# Latency buckets in seconds, from cache hits to slow LLM generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Stage timings (name, seconds) of the current request, used for the Server-Timing header
+request_timings = ContextVar("request_timings", default=None)
+
+
+def _escape_label(value) -> str:
+    # Escapes of the Prometheus text format for label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram with cumulative buckets, one series per label set
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][position] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', str(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Counter:
+    """
+    A Prometheus-style monotonically increasing counter, one series per label set
+    """
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._series.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class GaugeCallback:
+    """
+    A gauge whose series are read from a callback at scrape time
+
+    The callback returns a dictionary of label dictionaries (as tuples of pairs) to values,
+    so the state of caches and pools is reported without instrumenting them.
+    """
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], Dict[tuple, float]]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            series = self.callback()
+        except Exception as error:
+            # A component that is not initialized yet must not break the whole scrape
+            print(f"Metrics callback {self.name} failed: {error}")
+            return lines
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Registry:
+    """
+    Collect metrics and render them in the Prometheus text exposition format
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram("rag_stage_seconds", "Time spent in each stage of the RAG pipeline"))
+stage_wait_seconds = registry.register(Histogram("rag_stage_wait_seconds", "Time spent waiting for a free stage slot"))
+request_seconds = registry.register(Histogram("rag_request_seconds", "Total request time per endpoint"))
+cache_events = registry.register(Counter("rag_cache_events_total", "Cache lookups per cache and result"))
+degraded_answers = registry.register(Counter("rag_degraded_answers_total", "Requests answered without a generated answer, per reason"))
+coalesced_requests = registry.register(Counter("rag_coalesced_requests_total", "Requests served by an identical in-flight computation"))
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """
+    Time a stage of the pipeline, for the stage histogram and the Server-Timing header
+
+    Parameters:
+        stage (str): the stage name, e.g. embedding, opensearch, filter, prompt_build, llm or postprocess
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def server_timing_header(timings: List[Tuple[str, float]]) -> str:
+    """
+    Format stage timings as a Server-Timing header, repeated stages are summed
+
+    Parameters:
+        timings (List[Tuple[str, float]]): the stage names and durations in seconds
+
+    Returns:
+        str: e.g. "embedding;dur=12.1, opensearch;dur=8.4"
+    """
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items())
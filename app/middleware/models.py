@@ -1,9 +1,79 @@
+import math
+import threading
+
+import torch
 from angle_emb import AnglE, Prompts
 
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_core.pydantic_v1 import Field
 from langchain_core.documents.base import Document
-from typing import List
+from typing import Any, List, Optional, Tuple
+
+from batching import EmbeddingBatcher
+from cache import EmbeddingCache, TTLCache
+from concurrency import stage_limiter
+from metrics import timed_stage
+from connections import call_with_retries
+from filters import compile_filter
+from search import knn_query, hits_to_documents, bm25_query, reciprocal_rank_fusion
+from config import RRF_RANK_CONSTANT, RETRIEVAL_MAX_K, RETRIEVAL_K_GROWTH
+
+
+def load_angle(device: str = "auto", quantize: bool = False, num_threads: int = 0) -> AnglE:
+    """
+    Load the UAE-Large-V1 AnglE model on the requested device
+
+    Parameters:
+        device (str): cuda, cpu or auto to pick cuda when it is available
+        quantize (bool): apply dynamic int8 quantization to the linear layers (cpu only)
+        num_threads (int): the number of torch intra-op threads on cpu, 0 keeps the torch default
+
+    Returns:
+        AnglE: the loaded model ready for inference
+    """
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    angle = AnglE.from_pretrained("WhereIsAI/UAE-Large-V1", pooling_strategy="cls")
+    angle.device = device
+    if device == "cuda":
+        return angle.cuda()
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if quantize:
+        angle.backbone = torch.quantization.quantize_dynamic(angle.backbone, {torch.nn.Linear}, dtype=torch.qint8)
+    angle.backbone.eval()
+    return angle
+
+
+# Loaded AnglE models by (text_type, device, quantize), shared by every AnglEModel of the process
+_shared_angles = {}
+_shared_angles_lock = threading.Lock()
+
+
+def shared_angle(text_type: str = "query", device: str = "auto", quantize: bool = False, num_threads: int = 0) -> AnglE:
+    """
+    Load the AnglE model once per process, so workers forked after a preload share its weights
+
+    Parameters:
+        text_type (str): the type of the text to be embedded, passage or query
+        device (str): cuda, cpu or auto to pick cuda when it is available
+        quantize (bool): apply dynamic int8 quantization to the linear layers (cpu only)
+        num_threads (int): the number of torch intra-op threads on cpu, only applied on the first load
+
+    Returns:
+        AnglE: the loaded model with the prompt of the text type set
+    """
+    key = (text_type, device, quantize)
+    with _shared_angles_lock:
+        if key not in _shared_angles:
+            angle = load_angle(device=device, quantize=quantize, num_threads=num_threads)
+            # Enable Prompt.C for retrieval optimized embeddings
+            if text_type == "query":
+                angle.set_prompt(prompt=Prompts.C)
+            _shared_angles[key] = angle
+        return _shared_angles[key]
 
 
 class AnglEModel:
@@ -12,22 +82,36 @@ class AnglEModel:
 
     Attributes:
         angel (model): Angle embedding model
+        text_type (str): the type of the text to be embedded, passage or query
+        cache (EmbeddingCache): optional cache for repeated queries
+        batcher (EmbeddingBatcher): optional micro-batcher shared by concurrent queries
     """
 
-    def __init__(self, text_type: str = "query") -> None:
+    def __init__(self, text_type: str = "query", cache: Optional[EmbeddingCache] = None,
+                 max_batch_size: int = 1, max_wait_ms: float = 5.0,
+                 device: str = "auto", quantize: bool = False, num_threads: int = 0, angle: Any = None) -> None:
         """
         Initialize the Angle model with text type
 
         Parameters:
             text_type (str): the type of the text to be embedded, passage or query
+            cache (EmbeddingCache): the cache to look up repeated queries in, None disables caching
+            max_batch_size (int): the maximum number of concurrent queries encoded together, 1 disables batching
+            max_wait_ms (float): how long a query waits for others to join its batch
+            device (str): cuda, cpu or auto to pick cuda when it is available
+            quantize (bool): use dynamic int8 quantized weights on cpu
+            num_threads (int): the number of torch threads on cpu, 0 keeps the torch default
+            angle (AnglE): an already loaded AnglE compatible model, None loads the shared UAE-Large-V1
         """
-        self.angle = AnglE.from_pretrained(
-            "WhereIsAI/UAE-Large-V1", pooling_strategy="cls"
-        ).cuda()
+        self.text_type = text_type
+        self.cache = cache
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = EmbeddingBatcher(self.embed_documents, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
 
-        # Enable Prompt.C for retrieval optimized embeddings
-        if text_type == "query":
-            self.angle.set_prompt(prompt=Prompts.C)
+        if angle is None:
+            angle = shared_angle(text_type=text_type, device=device, quantize=quantize, num_threads=num_threads)
+        self.angle = angle
 
     def embed_query(self, query: str = None) -> List[float]:
         """
@@ -39,11 +123,60 @@ class AnglEModel:
         Returns:
             List[float]: a list of floats with a length of 1024
         """
-        self.angle
+        if self.cache is not None:
+            cached = self.cache.get_embedding(query, self.text_type)
+            if cached is not None:
+                return cached
+
+        with timed_stage("embedding"):
+            if self.batcher is not None:
+                embedding = self.batcher.embed(query)
+            else:
+                with stage_limiter.stage("embedding"):
+                    embedding = self.angle.encode({"text": query}, to_numpy=True).tolist()[0]
+
+        if self.cache is not None:
+            self.cache.put_embedding(query, self.text_type, embedding)
+        return embedding
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Generate embeddings for several queries, only the ones missing from the cache are encoded (in one batch)
 
-        embedding = self.angle.encode({"text": query}, to_numpy=True)
+        Parameters:
+            queries (List[str]): the queries to be embedded
 
-        return embedding.tolist()[0]
+        Returns:
+            List[List[float]]: one embedding with a length of 1024 per query
+        """
+        embeddings = [None] * len(queries)
+        if self.cache is not None:
+            embeddings = [self.cache.get_embedding(query, self.text_type) for query in queries]
+
+        missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with timed_stage("embedding"):
+                encoded = self.embed_documents([queries[position] for position in missing])
+            for position, embedding in zip(missing, encoded):
+                embeddings[position] = embedding
+                if self.cache is not None:
+                    self.cache.put_embedding(queries[position], self.text_type, embedding)
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generate embeddings for several texts with a single forward pass
+
+        Parameters:
+            texts (List[str]): the texts to be embedded
+
+        Returns:
+            List[List[float]]: one embedding with a length of 1024 per text
+        """
+        with stage_limiter.stage("embedding"):
+            embeddings = self.angle.encode([{"text": text} for text in texts], to_numpy=True)
+
+        return embeddings.tolist()
 
 
 class RetrievalFilter:
@@ -51,37 +184,32 @@ class RetrievalFilter:
     """
     Helper Class to encapsulate the filtering logic for the retrieved documents.
 
-    Filtering options:
+    Filtering options (see filters.py for the full filter language):
 
     - title - is particular title included or not?
     -> empty string - no title 
-    -> if one string - check if included or not
     -> field: metadata.title
-    - year - particular year range included or not? 
-    -> start and end
-    -> start and end - if the same, then only that year 
-    -> empty string - no year
+    - years / exclude_years - particular years or year ranges included (excluded) or not?
+    -> "start-end" entries are treated as inclusive ranges
+    -> empty list - no year
     -> field: metadata.year
-    - keywords - included or not 
+    - keywords / any_keywords / exclude_keywords - all of, any of or none of the keywords included
     -> empty list - no keywords 
-    -> otherwise - loop through list and check if included or not
     -> field: page_content
+    - any_of / none_of - OR and NOT over nested filters
+
+    The filter is compiled once into a single pass over the documents, and into an OpenSearch
+    pre-filter with to_opensearch_filter, so that the k-NN search skips documents that cannot match.
+    The pre-filter covers years and excluded words only, substring matches are checked by apply.
 
     """
 
     def __init__(self, filter_dict: dict):
 
-        self._target_title = filter_dict["title"]
-        self._target_years = [year.strip() for year in filter_dict["years"]]
-        self._target_keywords = [keyword.strip() for keyword in filter_dict["keywords"]]
-
-        print(f"Title: {self._target_title}")
-        print(f"Years: {self._target_years}")
-        print(f"Keywords: {self._target_keywords}")
+        self._compiled = compile_filter(filter_dict)
+        print(f"Filter: {self._compiled.signature}")
 
-        if self._target_title == "" and \
-           self._target_years == [] and \
-           self._target_keywords == []:
+        if self._compiled.is_empty():
             self._filter_type = "no_filter"
         else:
             self._filter_type = "filter"
@@ -89,71 +217,257 @@ class RetrievalFilter:
     def get_filter_type(self) -> str:
         return self._filter_type
 
-    def _apply_title_filter(self, doc_list: List[Document]) -> List[Document]:
-        if not isinstance(self._target_title, str) or not self._target_title.strip():  # Check if title is a string and not empty or whitespace
-            return doc_list
-        return [doc for doc in doc_list if self._target_title.lower() in doc.metadata["title"].lower()]
-
-    def _apply_years_filter(self, doc_list: List[Document]) -> List[Document]:
-        if not isinstance(self._target_years, list) or not all(isinstance(year, str) for year in self._target_years):  # Check if years is a list of strings
-            return doc_list
-        
-        # if self._target_years is a list of empty strings, return doc_list
-        if all(not year for year in self._target_years):
-            return doc_list
+    def signature(self) -> str:
+        """
+        A canonical representation of the filter, equal for equal filters
+        """
+        return self._compiled.signature
 
-        return [doc for doc in doc_list if str(doc.metadata["year"]) in self._target_years]
+    def to_opensearch_filter(self) -> dict:
+        """
+        The OpenSearch pre-filter of the filter, usable as a k-NN efficient filter
 
-    def _apply_keywords_filter(self, doc_list: List[Document]) -> List[Document]:
-        if not isinstance(self._target_keywords, list) or not all(isinstance(keyword, str) for keyword in self._target_keywords):  # Check if keywords is a list of strings
-            return doc_list
-        
-        # if self._target_years is a list of empty strings, return doc_list
-        if all(not keyword for keyword in self._target_keywords):
-            return doc_list
-        
-        print("target_keywords: ", self._target_keywords)
-        print("page_content0: ", doc_list[0].page_content.lower())
-        
+        It keeps every matching document but may keep others, see is_exact.
 
-        return [doc for doc in doc_list if all(keyword.lower() in doc.page_content.lower() for keyword in self._target_keywords)]
-    
+        Returns:
+            dict: the bool query, or an empty dict when nothing can be filtered in OpenSearch
+        """
+        return self._compiled.clause
 
+    def is_exact(self) -> bool:
+        """
+        Whether the OpenSearch pre-filter keeps exactly the matching documents
+        """
+        return self._compiled.exact
 
     def apply(self, doc_list: List[Document]) -> List[Document]:
 
         if self._filter_type == "no_filter":
             return doc_list
+
+        return self._compiled.apply(doc_list)
         
-        print(f"Applying filter: {self._filter_type}")
-        filters = [self._apply_title_filter, self._apply_years_filter, self._apply_keywords_filter]
-
-        for filter in filters:
-            print(f"Applying filter: {filter.__name__}")
-            print(f"Length of doc_list: {len(doc_list)}")
-            doc_list = filter(doc_list)
-            print(f"Length of doc_list after filtering: {len(doc_list)}")
-        return doc_list
-        
+
+class FilterStats:
+    """
+    Track how many of the retrieved documents the Python-side check of each filter keeps, to predict a good starting k
+
+    Attributes:
+        smoothing (float): the weight of the latest observation in the moving average
+    """
+
+    def __init__(self, max_filters: int = 1024, smoothing: float = 0.3) -> None:
+        self.smoothing = smoothing
+        self._selectivity = TTLCache(max_size=max_filters)
+
+    def observe(self, signature: str, returned: int, kept: int) -> None:
+        """
+        Record one retrieval round of a filter
+
+        Parameters:
+            signature (str): the filter signature
+            returned (int): the number of documents returned by the search
+            kept (int): the number of documents kept by the filter
+        """
+        if returned == 0:
+            return
+        selectivity = kept / returned
+        previous = self._selectivity.get(signature)
+        if previous is not None:
+            selectivity = self.smoothing * selectivity + (1 - self.smoothing) * previous
+        self._selectivity.put(signature, selectivity)
+
+    def initial_k(self, signature: str, target: int, base_k: int, max_k: int) -> int:
+        """
+        Predict the k that yields target documents after filtering, within [base_k, max_k]
+        """
+        selectivity = self._selectivity.get(signature)
+        if selectivity is None:
+            return base_k
+        # 50% headroom over the expected need, so one round trip is usually enough
+        needed = math.ceil(1.5 * target / max(selectivity, 0.01))
+        return min(max(base_k, needed), max_k)
+
+
+filter_stats = FilterStats()
+
 
 class VariableRetriever(VectorStoreRetriever):
     """
     A class to wrap around the Langchain VectorStoreRetriever class to enable 
-    metadata filtering after retrieval as part of the RAG pipeline
+    metadata filtering as part of the RAG pipeline
+
+    The year and excluded word criteria of the filter are pushed down into the k-NN
+    query (efficient filtering on the lucene engine), so the top-k neighbours are
+    drawn from the candidates that can match. The full filter, with its substring
+    matching of titles and keywords, is applied in Python to the returned hits.
+
+    search_mode selects dense (k-NN), bm25 (lexical match on chunk and title, no
+    embedding needed) or hybrid (both in one _msearch, merged by reciprocal rank fusion).
+    An optional reranker (CrossEncoderReranker) reorders the filtered candidates
+    before the top_n cut. When the Python-side check of the filter keeps fewer than
+    top_n documents, the search is repeated with a geometrically growing k up to
+    RETRIEVAL_MAX_K.
     """
     vectorstore: VectorStoreRetriever
     search_type: str = "similarity"
     search_kwargs: dict = Field(default_factory=dict)
     retrieval_filter: RetrievalFilter
+    search_mode: str = "dense"
+    reranker: Optional[Any] = None
+    top_n: int = 3
 
     
-    def get_relevant_documents(self, query: str) -> List[Document]:
-        results =  self.vectorstore.get_relevant_documents(query=query)
+    def _k_bounds(self) -> Tuple[int, int]:
+        base_k = self.vectorstore.search_kwargs.get("k", 20)
+        return base_k, max(base_k, RETRIEVAL_MAX_K)
+
+    def initial_k(self) -> int:
+        """
+        The number of candidates to fetch first, predicted from the past selectivity of the filter
+        """
+        base_k, max_k = self._k_bounds()
+        # Deep result pages (a large top_n) need more candidates than the default k
+        base_k = min(max(base_k, self.top_n), max_k)
+        # Without a residual Python-side check every returned hit is kept
+        if self.retrieval_filter.get_filter_type() == "no_filter" or self.retrieval_filter.is_exact():
+            return base_k
+        return filter_stats.initial_k(self.retrieval_filter.signature(), self.top_n, base_k, max_k)
+
+    def knn_body(self, embedding: List[float], k: int = None) -> dict:
+        """
+        Build the k-NN query for an embedded question with the filter pushed down
+        """
+        search_kwargs = self.vectorstore.search_kwargs
+        return knn_query(
+            embedding,
+            k=k or search_kwargs.get("k", 20),
+            efficient_filter=self.retrieval_filter.to_opensearch_filter(),
+            vector_field=search_kwargs.get("vector_field", "embedding"),
+        )
+
+    def bm25_body(self, query: str, k: int = None) -> dict:
+        """
+        Build the BM25 query for a question with the filter pushed down
+        """
+        return bm25_query(query, k=k or self.vectorstore.search_kwargs.get("k", 20),
+                          os_filter=self.retrieval_filter.to_opensearch_filter())
+
+    def filter_hits(self, hits: List[dict]) -> List[Document]:
+        """
+        Convert the hits to documents, apply the filter and record its selectivity
+        """
+        results = hits_to_documents(hits, text_field=self.vectorstore.search_kwargs.get("text_field", "chunk"))
         print(f"Length of results: {len(results)}")
-        filtered_results = self.retrieval_filter.apply(results) 
+        with timed_stage("filter"):
+            filtered_results = self.retrieval_filter.apply(results) 
         print(f"Length of filtered results: {len(filtered_results)}")
 
-        if len(filtered_results) > 3:
-            return filtered_results[:3]
+        if self.retrieval_filter.get_filter_type() != "no_filter" and not self.retrieval_filter.is_exact():
+            filter_stats.observe(self.retrieval_filter.signature(), len(results), len(filtered_results))
+        return filtered_results
+
+    def top_documents(self, query: str, filtered_results: List[Document]) -> List[Document]:
+        """
+        Rerank the filtered documents if enabled and keep the top_n
+        """
+        if self.reranker is not None:
+            filtered_results = self.reranker.rerank(query, filtered_results)
+
+        if len(filtered_results) > self.top_n:
+            return filtered_results[:self.top_n]
         else:
-            return filtered_results
\ No newline at end of file
+            return filtered_results
+
+    def select_documents(self, query: str, hits: List[dict]) -> List[Document]:
+        """
+        Convert the hits to documents, apply the filter, rerank if enabled and keep the top_n
+        """
+        return self.top_documents(query, self.filter_hits(hits))
+
+    def _deepening_search(self, make_body) -> List[Document]:
+        """
+        Search with a growing k until the filter keeps top_n documents
+
+        Only filters with a residual Python-side check (substring matches of titles and
+        keywords, see RetrievalFilter.is_exact) can drop hits. For the others OpenSearch
+        already returns matching documents only, so a single search is made.
+
+        Parameters:
+            make_body (Callable[[int], dict]): builds the search body for a given k
+
+        Returns:
+            List[Document]: the filtered documents of the last round
+        """
+        store = self.vectorstore.vectorstore
+        _, max_k = self._k_bounds()
+        k = self.initial_k()
+        while True:
+            with stage_limiter.stage("opensearch"), timed_stage("opensearch"):
+                response = call_with_retries(store.client.search, index=store.index_name, body=make_body(k))
+            hits = response["hits"]["hits"]
+            filtered_results = self.filter_hits(hits)
+
+            # Stop when there are enough documents, the index has no more matches or k hit the cap
+            if (self.retrieval_filter.is_exact() or len(filtered_results) >= self.top_n
+                    or len(hits) < k or k >= max_k):
+                return filtered_results
+            k = min(k * RETRIEVAL_K_GROWTH, max_k)
+            print(f"Widening the search to k={k}")
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        store = self.vectorstore.vectorstore
+
+        if self.search_mode == "bm25":
+            return self.top_documents(query, self._deepening_search(lambda k: self.bm25_body(query, k)))
+
+        # Embedding and k-NN search are separate stages, so that each is bounded by its own limit
+        embedding = store.embedding_function.embed_query(query)
+
+        if self.search_mode == "hybrid":
+            k = self.initial_k()
+            body = [{"index": store.index_name}, self.bm25_body(query, k), {"index": store.index_name}, self.knn_body(embedding, k)]
+            with stage_limiter.stage("opensearch"), timed_stage("opensearch"):
+                response = call_with_retries(store.client.msearch, body=body)
+            for result in response["responses"]:
+                if "error" in result:
+                    raise RuntimeError(f"OpenSearch query failed: {result['error']}")
+            hits = reciprocal_rank_fusion(
+                [result["hits"]["hits"] for result in response["responses"]],
+                size=k,
+                rank_constant=RRF_RANK_CONSTANT,
+            )
+            return self.select_documents(query, hits)
+
+        return self.top_documents(query, self._deepening_search(lambda k: self.knn_body(embedding, k)))
+
+
+def batch_retrieve(retrievers: List[VariableRetriever], queries: List[str]) -> List[List[Document]]:
+    """
+    Retrieve the documents for several questions with one embedding batch and one _msearch call
+
+    Parameters:
+        retrievers (List[VariableRetriever]): one retriever (with its filter) per question, sharing the same store
+        queries (List[str]): the questions
+
+    Returns:
+        List[List[Document]]: the filtered documents for each question
+    """
+    if not queries:
+        return []
+    store = retrievers[0].vectorstore.vectorstore
+
+    embeddings = store.embedding_function.embed_queries(queries)
+    body = []
+    for retriever, embedding in zip(retrievers, embeddings):
+        body.append({"index": store.index_name})
+        body.append(retriever.knn_body(embedding, retriever.initial_k()))
+    with stage_limiter.stage("opensearch"), timed_stage("opensearch"):
+        response = call_with_retries(store.client.msearch, body=body)
+
+    documents = []
+    for retriever, query, result in zip(retrievers, queries, response["responses"]):
+        if "error" in result:
+            raise RuntimeError(f"OpenSearch query failed: {result['error']}")
+        documents.append(retriever.select_documents(query, result["hits"]["hits"]))
+    return documents
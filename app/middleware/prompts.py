@@ -0,0 +1,37 @@
+from langchain_core.prompts import ChatPromptTemplate
+
+
+# Local copy of the "rlm/rag-prompt" prompt from the LangChain hub, so that
+# the middleware does not need network access to start
+RAG_PROMPT_TEMPLATE = (
+    "You are an assistant for question-answering tasks. "
+    "Use the following pieces of retrieved context to answer the question. "
+    "If you don't know the answer, just say that you don't know. "
+    "Use three sentences maximum and keep the answer concise.\n"
+    "Question: {question} \n"
+    "Context: {context} \n"
+    "Answer:"
+)
+
+RAG_PROMPT = ChatPromptTemplate.from_messages([("human", RAG_PROMPT_TEMPLATE)])
+
+# Identifies the prompt used to generate cached answers, bump it when the prompt changes
+PROMPT_VERSION = "rlm/rag-prompt:1"
+
+
+def static_prefix(prompt: ChatPromptTemplate = RAG_PROMPT) -> str:
+    """
+    The rendered text of a prompt up to its first variable, identical for every request
+
+    Trailing whitespace is left out: tokenizers merge a space with the following word, so a prefix
+    ending in a space would not tokenize like the start of the full prompt.
+
+    Parameters:
+        prompt (ChatPromptTemplate): the prompt, with the question and context variables
+
+    Returns:
+        str: the prefix of the string the LLM receives, e.g. "Human: You are an assistant..."
+    """
+    marker = "\x00"
+    rendered = prompt.format(**{variable: marker for variable in prompt.input_variables})
+    return rendered[:rendered.index(marker)].rstrip()
@@ -0,0 +1,116 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import List
+
+from langchain_core.documents.base import Document
+
+from cache import TTLCache, normalize_query
+from metrics import timed_stage
+
+
+class CrossEncoderReranker:
+    """
+    Rerank retrieved chunks with a small cross-encoder under a hard latency budget
+
+    The candidates missing from the score cache are scored in one batch. If the
+    batch does not finish within the budget the documents keep their ANN order;
+    a batch already running still fills the cache for the next request, a batch
+    still queued is cancelled. When every worker is busy the request does not queue
+    another batch and keeps the ANN order at once, so the backlog stays bounded.
+
+    Attributes:
+        budget_ms (float): the maximum time a request waits for the scores
+        cache (TTLCache): scores per (query, pmid, chunk_id) pair
+        reranked (int): the number of requests served in cross-encoder order
+        fallbacks (int): the number of requests that exceeded the budget
+    """
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", budget_ms: float = 150,
+                 cache_size: int = 20000, max_length: int = 256, workers: int = 2) -> None:
+        # Optional dependency, only needed when reranking is enabled
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu", max_length=max_length)
+        self.budget_ms = budget_ms
+        self.cache = TTLCache(max_size=cache_size, name="rerank_scores")
+        self.reranked = 0
+        self.fallbacks = 0
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reranker")
+        # Batches submitted and not finished or cancelled yet
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: str, document: Document) -> tuple:
+        return (normalize_query(query), document.metadata.get("pmid"), document.metadata.get("chunk_id"))
+
+    def _score(self, query: str, documents: List[Document], keys: List[tuple]) -> List[float]:
+        scores = self.model.predict([(query, document.page_content) for document in documents]).tolist()
+        for key, score in zip(keys, scores):
+            self.cache.put(key, score)
+        return scores
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        """
+        Order the documents by cross-encoder relevance, or keep the ANN order when over budget
+
+        Parameters:
+            query (str): the question asked by the user
+            documents (List[Document]): the filtered candidates in ANN order
+
+        Returns:
+            List[Document]: the candidates, best first
+        """
+        if len(documents) < 2:
+            return documents
+        with timed_stage("rerank"):
+            return self._rerank(query, documents)
+
+    def _rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        started = time.perf_counter()
+
+        keys = [self._key(query, document) for document in documents]
+        scores = [self.cache.get(key) for key in keys]
+        missing = [position for position, score in enumerate(scores) if score is None]
+        if missing:
+            with self._lock:
+                busy = self._pending >= self.workers
+                if busy:
+                    self.fallbacks += 1
+                else:
+                    self._pending += 1
+            if busy:
+                return documents
+
+            future = self._executor.submit(
+                self._score, query, [documents[position] for position in missing], [keys[position] for position in missing]
+            )
+            future.add_done_callback(self._finished)
+            remaining = self.budget_ms / 1000 - (time.perf_counter() - started)
+            try:
+                for position, score in zip(missing, future.result(timeout=max(remaining, 0))):
+                    scores[position] = score
+            except TimeoutError:
+                # Nobody waits for a batch that has not started yet
+                future.cancel()
+                with self._lock:
+                    self.fallbacks += 1
+                return documents
+
+        with self._lock:
+            self.reranked += 1
+        order = sorted(range(len(documents)), key=lambda position: scores[position], reverse=True)
+        return [documents[position] for position in order]
+
+    def _finished(self, future) -> None:
+        # Also called when the batch is cancelled
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self) -> dict:
+        stats = {"reranked": self.reranked, "fallbacks": self.fallbacks, "budget_ms": self.budget_ms,
+                 "pending": self._pending}
+        stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,98 @@
+from langchain_core.documents.base import Document
+from typing import List
+
+
+# Fields of the pubmed index that are never needed by the middleware
+EXCLUDED_SOURCE_FIELDS = ["embedding", "vector_field"]
+
+
+def knn_query(embedding: List[float], k: int = 20, efficient_filter: dict = None, vector_field: str = "embedding") -> dict:
+    """
+    Build an OpenSearch k-NN query body
+
+    Parameters:
+        embedding (List[float]): the query embedding
+        k (int): the number of neighbours to return
+        efficient_filter (dict): an optional OpenSearch filter applied during the k-NN search (lucene engine)
+        vector_field (str): the name of the knn_vector field
+
+    Returns:
+        dict: the search body
+    """
+    knn = {"vector": embedding, "k": k}
+    if efficient_filter:
+        knn["filter"] = efficient_filter
+
+    return {
+        "size": k,
+        "query": {"knn": {vector_field: knn}},
+        "_source": {"excludes": EXCLUDED_SOURCE_FIELDS},
+    }
+
+
+def hits_to_documents(hits: List[dict], text_field: str = "chunk") -> List[Document]:
+    """
+    Convert OpenSearch hits into LangChain documents
+
+    Parameters:
+        hits (List[dict]): the hits of an OpenSearch response
+        text_field (str): the source field holding the text of the document
+
+    Returns:
+        List[Document]: the documents with the source fields and the score as metadata
+    """
+    documents = []
+    for hit in hits:
+        metadata = dict(hit["_source"])
+        metadata["score"] = hit["_score"]
+        documents.append(Document(page_content=hit["_source"][text_field], metadata=metadata))
+    return documents
+
+
+def bm25_query(query: str, k: int = 20, os_filter: dict = None) -> dict:
+    """
+    Build an OpenSearch BM25 query body on the chunk text and the title
+
+    Parameters:
+        query (str): the question asked by the user
+        k (int): the number of hits to return
+        os_filter (dict): an optional OpenSearch filter clause, e.g. from RetrievalFilter.to_opensearch_filter
+
+    Returns:
+        dict: the search body
+    """
+    bool_query = {"must": [{"multi_match": {"query": query, "fields": ["chunk", "title"]}}]}
+    if os_filter:
+        bool_query["filter"] = [os_filter]
+
+    return {
+        "size": k,
+        "query": {"bool": bool_query},
+        "_source": {"excludes": EXCLUDED_SOURCE_FIELDS},
+    }
+
+
+def reciprocal_rank_fusion(hit_lists: List[List[dict]], size: int = 20, rank_constant: int = 60) -> List[dict]:
+    """
+    Merge several ranked hit lists with reciprocal rank fusion
+
+    Each hit scores the sum of 1 / (rank_constant + rank) over the lists it appears in,
+    so no score normalization between BM25 and k-NN is needed.
+
+    Parameters:
+        hit_lists (List[List[dict]]): the hits of each OpenSearch response, best first
+        size (int): the number of fused hits to return
+        rank_constant (int): damps the influence of the top ranks, 60 is the usual value
+
+    Returns:
+        List[dict]: the fused hits, best first, with the fused score as _score
+    """
+    scores = {}
+    hits_by_id = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + 1.0 / (rank_constant + rank)
+            hits_by_id.setdefault(hit["_id"], hit)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [dict(hits_by_id[hit_id], _score=scores[hit_id]) for hit_id in fused]
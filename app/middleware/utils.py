@@ -1,5 +1,23 @@
+import base64
+import json
+
+import numpy as np
 from opensearchpy import OpenSearch
 from models import AnglEModel
+from cache import EmbeddingCache
+from connections import get_client, get_async_client, call_with_retries
+from local_store import LocalVectorStore
+from config import EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_PATH
+from config import EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT_MS
+from config import EMBEDDING_DEVICE, EMBEDDING_QUANTIZE, EMBEDDING_NUM_THREADS
+from config import VECTOR_STORE_BACKEND, LOCAL_STORE_PATH, LOCAL_STORE_HNSW
+from config import EMBEDDING_BACKEND, FAKE_EMBEDDING_DIMENSION, FAKE_EMBEDDING_MS
+from config import LLM_MODEL, FAKE_LLM_TOKENS, FAKE_LLM_TOKEN_MS
+from config import LLAMA_MODEL_PATH, LLAMA_SERVER_URL, LLM_MAX_TOKENS, LLM_THREADS, LLM_CONTEXT_SIZE
+from config import PROMPT_PREFIX_CACHE
+from fakes import HashingEncoder, FakeTokenLLM
+from local_llm import llama_cpp_model, LlamaServerLLM
+from prompts import static_prefix, PROMPT_VERSION
 from langchain_community.vectorstores import OpenSearchVectorSearch
 from langchain_community.llms import Replicate
 from langchain import HuggingFaceHub
@@ -36,24 +54,12 @@ def pretty_response(response):
 
 def os_client():
     """
-    Create a new OpenSearch client object
+    Return the OpenSearch client shared by the middleware
 
     Returns:
-        OpenSearch: an OpenSearch object that represent the running instance using default settings
-    """
-    # OpenSearch instance parameters
-    host = "opensearch"
-    port = 9200
-    auth = ("admin", "admin")
-
-    # Create the client with SSL/TLS enabled and disable warnings
-    return OpenSearch(
-        hosts=[{"host": host, "port": port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+        OpenSearch: an OpenSearch object with the pooled connection settings from config.py
+    """
+    return get_client()
 
 
 
@@ -99,6 +105,74 @@ logistic regression prediction model, was developed to identify factors associat
 """
 
 
+def embedding_model() -> AnglEModel:
+    """
+    Create the query embedding model with the cache, batching and device settings from config.py
+
+    Returns:
+        AnglEModel: the embedding model used by the vector stores
+    """
+    embedding_cache = EmbeddingCache(
+        max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, path=EMBEDDING_CACHE_PATH
+    )
+
+    # The fake encoder keeps the cache, batching and stage limits of the real model
+    angle = None
+    if EMBEDDING_BACKEND == "fake":
+        angle = HashingEncoder(dimension=FAKE_EMBEDDING_DIMENSION, latency_ms=FAKE_EMBEDDING_MS)
+
+    return AnglEModel(
+        cache=embedding_cache, max_batch_size=EMBEDDING_BATCH_SIZE, max_wait_ms=EMBEDDING_BATCH_WAIT_MS,
+        device=EMBEDDING_DEVICE, quantize=EMBEDDING_QUANTIZE, num_threads=EMBEDDING_NUM_THREADS, angle=angle
+    )
+
+
+def vector_store(index_name: str = None):
+    """
+    Create the vector store of the backend selected by VECTOR_STORE_BACKEND in config.py
+
+    Parameters:
+        index_name (str): the name of OpenSearch index where documents are stored
+
+    Returns:
+        OpenSearchVectorSearch or LocalVectorStore: LangChain vector store object
+    """
+    if VECTOR_STORE_BACKEND == "local":
+        return local_vector_store(index_name=index_name)
+    return opensearch_vector_store(index_name=index_name)
+
+
+def local_vector_store(index_name: str = None, folder: str = LOCAL_STORE_PATH):
+    """
+    Create an in-process vector store from a local index built with local_store.py
+
+    Parameters:
+        index_name (str): the name reported for the index
+        folder (str): the folder holding the memory-mapped embeddings and the metadata sidecar
+
+    Returns:
+        LocalVectorStore: LangChain vector store object backed by the local index
+    """
+    return LocalVectorStore(folder, embedding_function=embedding_model(), index_name=index_name, hnsw=LOCAL_STORE_HNSW)
+
+
+class PooledOpenSearchVectorSearch(OpenSearchVectorSearch):
+    """
+    OpenSearchVectorSearch over the shared, pooled clients of connections.py
+
+    The parent constructor always creates its own clients from a URL, so it is not called.
+    """
+
+    def __init__(self, index_name: str, embedding_function) -> None:
+        self.embedding_function = embedding_function
+        self.index_name = index_name
+        # A self-hosted OpenSearch, not Amazon OpenSearch Serverless
+        self.is_aoss = False
+        self.client = get_client()
+        self.async_client = get_async_client()
+        self.engine = None
+
+
 def opensearch_vector_store(index_name: str = None):
     """
     Create an OpenSearch vector store for RAG pipeline
@@ -107,25 +181,75 @@ def opensearch_vector_store(index_name: str = None):
         index_name (str): the name of OpenSearch index where documents are stored
 
     Returns:
-        OpenSearchVectorSearch: LangChain OpenSearch vector store object
+        OpenSearchVectorSearch: LangChain OpenSearch vector store object on OPENSEARCH_HOST
     """
     if index_name is not None:
 
-        os_store = OpenSearchVectorSearch(
-            embedding_function=AnglEModel(),
-            index_name=index_name,
-            opensearch_url="https://opensearch:9200",
-            http_auth=("admin", "admin"),
-            use_ssl=False,
-            verify_certs=False,
-            ssl_assert_hostname=False,
-            ssl_show_warn=False,
-        )
+        os_store = PooledOpenSearchVectorSearch(index_name=index_name, embedding_function=embedding_model())
 
     return os_store
 
 
-def llm_model(name: str = "falcon-7b-instruct"):
+def index_version(client: OpenSearch, index_name: str) -> str:
+    """
+    Identify the current build of an index, it changes when the index is recreated or reloaded
+
+    Parameters:
+        client (OpenSearch): the client connected to the instance holding the index (or a LocalIndex)
+        index_name (str): the name of the index
+
+    Returns:
+        str: the index UUID and its document count
+    """
+    settings = call_with_retries(client.indices.get_settings, index=index_name)
+    uuid = settings[index_name]["settings"]["index"]["uuid"]
+    count = call_with_retries(client.count, index=index_name)["count"]
+    return f"{uuid}:{count}"
+
+
+def embedding_drift(embedding_model: AnglEModel, client: OpenSearch, index_name: str, sample_size: int = 100) -> dict:
+    """
+    Measure how far the embeddings of the running model drift from the fp32 embeddings stored in the index
+
+    Parameters:
+        embedding_model (AnglEModel): the (possibly quantized) embedding model in use
+        client (OpenSearch): the client connected to the instance holding the index
+        index_name (str): the index with the reference embeddings, e.g. pubmed_500_100
+        sample_size (int): the number of random chunks to re-embed
+
+    Returns:
+        dict: the number of compared chunks and the mean, minimum and 5th percentile cosine similarity
+    """
+    response = call_with_retries(
+        client.search,
+        index=index_name,
+        body={
+            "size": sample_size,
+            "query": {"function_score": {"query": {"match_all": {}}, "random_score": {}}},
+            "_source": ["chunk", "embedding"],
+        },
+    )
+    hits = response["hits"]["hits"]
+    if not hits:
+        return {"samples": 0}
+
+    stored = np.array([hit["_source"]["embedding"] for hit in hits], dtype=np.float32)
+    # The chunks were embedded with the same retrieval prompt as the queries (see data_embedding.py)
+    current = np.array(embedding_model.embed_documents([hit["_source"]["chunk"] for hit in hits]), dtype=np.float32)
+
+    stored /= np.linalg.norm(stored, axis=1, keepdims=True)
+    current /= np.linalg.norm(current, axis=1, keepdims=True)
+    similarities = np.sum(stored * current, axis=1)
+
+    return {
+        "samples": len(hits),
+        "mean_cosine": float(similarities.mean()),
+        "min_cosine": float(similarities.min()),
+        "p5_cosine": float(np.percentile(similarities, 5)),
+    }
+
+
+def llm_model(name: str = LLM_MODEL):
     """
     Create a new LLM model for langChain pipeline
 
@@ -146,9 +270,81 @@ def llm_model(name: str = "falcon-7b-instruct"):
         llm = HuggingFaceHub(
             repo_id=repo_id, model_kwargs={"temperature": 0.01, "max_new_tokens": 500}
         )        
+    elif name == "llamacpp":
+        llm = llama_cpp_model(
+            LLAMA_MODEL_PATH, max_tokens=LLM_MAX_TOKENS, threads=LLM_THREADS, context_size=LLM_CONTEXT_SIZE,
+            prompt_prefix=static_prefix() if PROMPT_PREFIX_CACHE else "", prompt_version=PROMPT_VERSION,
+        )
+    elif name == "llamacpp-server":
+        llm = LlamaServerLLM(
+            base_url=LLAMA_SERVER_URL, max_tokens=LLM_MAX_TOKENS,
+            prompt_prefix=static_prefix() if PROMPT_PREFIX_CACHE else "",
+        )
+    elif name == "fake":
+        llm = FakeTokenLLM(tokens=FAKE_LLM_TOKENS, token_ms=FAKE_LLM_TOKEN_MS)
     return llm
 
 
+def pubmed_url(pmid) -> str:
+    return f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
+
+
+def search_hit(document: Document) -> dict:
+    '''
+    Format a retrieved chunk as a lean search hit
+
+    Parameters:
+        document (Document): a chunk returned by the retriever
+
+    Returns:
+        dict: the pmid, title, year, score, PubMed URL, chunk id and text of the chunk
+    '''
+    metadata = document.metadata
+    return {
+        "pmid": metadata.get("pmid"),
+        "title": metadata.get("title"),
+        "year": metadata.get("year"),
+        "score": metadata.get("score"),
+        "url": pubmed_url(metadata.get("pmid")),
+        "chunk_id": metadata.get("chunk_id"),
+        "chunk": document.page_content,
+    }
+
+
+def encode_cursor(offset: int, signature: str) -> str:
+    '''
+    Encode the position of the next result page as an opaque cursor
+
+    Parameters:
+        offset (int): the rank of the first hit of the next page
+        signature (str): identifies the query, filter and mode the cursor belongs to
+
+    Returns:
+        str: the URL-safe cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset, "query": signature}).encode()).decode()
+
+
+def decode_cursor(cursor: str, signature: str) -> int:
+    '''
+    Decode a cursor of encode_cursor
+
+    Returns:
+        int: the rank of the first hit of the page
+
+    Raises:
+        ValueError: if the cursor is malformed or belongs to another query
+    '''
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        offset = int(position["offset"])
+    except (ValueError, KeyError, TypeError) as error:
+        raise ValueError("Malformed cursor") from error
+    if position.get("query") != signature or offset < 0:
+        raise ValueError("The cursor belongs to another query")
+    return offset
+
+
 def build_references(sources):
     '''
     Format a list of URLs from the source documents returned from the vector database
@@ -168,7 +364,7 @@ def build_references(sources):
         pmid = str(source.metadata['pmid'])
         # Create URLs for abstracts once and without duplicates
         if pmid not in pmids:
-            url = f"|https://pubmed.ncbi.nlm.nih.gov/{pmid}/"
+            url = "|" + pubmed_url(pmid)
             references += url
             pmids.append(pmid)
     return references
@@ -183,6 +379,23 @@ def processed_output(output: str):
     Returns:
         formatted_answer (str): A properly formatted answer to display in the web front-end
     '''
+    # Local models complete the prompt after "Answer:", so their output may not repeat it
+    if 'Answer:' not in output:
+        return output.strip()
     formatted_answer = output[output.find('Answer:') + 8:]
 
     return formatted_answer
+
+
+def sse_event(event: str, data: dict) -> str:
+    '''
+    Encode a server-sent event
+
+    Parameters:
+        event (str): the name of the event, e.g. references, token or done
+        data (dict): the payload, sent as JSON
+
+    Returns:
+        str: the event in the text/event-stream format
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
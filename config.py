@@ -8,3 +8,137 @@ api_tokens = {"HUGGINGFACEHUB_API_TOKEN": "...."}
 def set_api_keys():
     for key, value in api_tokens.items():
         os.environ[key] = value
+
+
+"""  Middleware settings, each of them can be overridden with an environment variable """
+
+# Query embedding cache (size in entries, TTL in seconds, empty path disables the on-disk tier)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+
+# Micro-batching of concurrent query embeddings (a batch size of 1 disables batching)
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", "5"))
+
+# Embedding device (auto, cuda or cpu), int8 quantization and torch threads for the cpu path
+EMBEDDING_DEVICE = os.environ.get("EMBEDDING_DEVICE", "auto")
+EMBEDDING_QUANTIZE = os.environ.get("EMBEDDING_QUANTIZE", "0") == "1"
+EMBEDDING_NUM_THREADS = int(os.environ.get("EMBEDDING_NUM_THREADS", "0"))
+# Number of indexed chunks re-embedded at startup to report the drift of quantized weights, 0 disables it
+EMBEDDING_DRIFT_SAMPLES = int(os.environ.get("EMBEDDING_DRIFT_SAMPLES", "50"))
+
+# The OpenSearch index holding the chunks and their embeddings
+INDEX_NAME = os.environ.get("INDEX_NAME", "pubmed_500_100")
+
+# End-to-end answer cache (size in entries, TTL in seconds, cosine similarity for semantic hits,
+# seconds between checks of the index version to invalidate answers after a rebuild)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.97"))
+ANSWER_CACHE_INDEX_CHECK = float(os.environ.get("ANSWER_CACHE_INDEX_CHECK", "60"))
+
+# Maximum number of concurrent calls per pipeline stage, further calls wait for a free slot
+STAGE_LIMIT_EMBEDDING = int(os.environ.get("STAGE_LIMIT_EMBEDDING", "2"))
+STAGE_LIMIT_OPENSEARCH = int(os.environ.get("STAGE_LIMIT_OPENSEARCH", "16"))
+# (the LLM limit is sized from the local LLM backends below)
+STAGE_LIMIT_LLM = int(os.environ.get("STAGE_LIMIT_LLM", "8"))
+# Size of the thread pool running the blocking pipeline off the event loop
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "64"))
+
+# Query run through retrieval before the server reports ready
+WARMUP_QUERY = os.environ.get("WARMUP_QUERY", "What are the risk factors for cerebral palsy?")
+
+# Shared OpenSearch connection pool (size defaults to the OpenSearch stage limit),
+# per-call timeout in seconds and retries with exponential backoff starting at OPENSEARCH_RETRY_BACKOFF seconds
+OPENSEARCH_HOST = os.environ.get("OPENSEARCH_HOST", "opensearch")
+OPENSEARCH_PORT = int(os.environ.get("OPENSEARCH_PORT", "9200"))
+OPENSEARCH_AUTH = (os.environ.get("OPENSEARCH_USER", "admin"), os.environ.get("OPENSEARCH_PASSWORD", "admin"))
+OPENSEARCH_POOL_SIZE = int(os.environ.get("OPENSEARCH_POOL_SIZE", str(STAGE_LIMIT_OPENSEARCH)))
+OPENSEARCH_TIMEOUT = float(os.environ.get("OPENSEARCH_TIMEOUT", "10"))
+OPENSEARCH_MAX_RETRIES = int(os.environ.get("OPENSEARCH_MAX_RETRIES", "3"))
+OPENSEARCH_RETRY_BACKOFF = float(os.environ.get("OPENSEARCH_RETRY_BACKOFF", "0.2"))
+
+# Batch endpoint: maximum number of questions per request and concurrent generations per request
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", "500"))
+BATCH_GENERATION_CONCURRENCY = int(os.environ.get("BATCH_GENERATION_CONCURRENCY", "4"))
+
+# Reciprocal rank fusion constant of the hybrid (BM25 + k-NN) search
+RRF_RANK_CONSTANT = int(os.environ.get("RRF_RANK_CONSTANT", "60"))
+
+# Vector store backend: opensearch, or local for an in-process index built with local_store.py
+# (memory-mapped embeddings, exact search or an optional HNSW graph)
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE_BACKEND", "opensearch")
+LOCAL_STORE_PATH = os.environ.get("LOCAL_STORE_PATH", "local_index")
+LOCAL_STORE_HNSW = os.environ.get("LOCAL_STORE_HNSW", "0") == "1"
+
+# Number of retrieved chunks sent to the LLM
+RETRIEVAL_TOP_N = int(os.environ.get("RETRIEVAL_TOP_N", "3"))
+# Optional cross-encoder reranking of the candidates (empty model name disables it),
+# with a per-request latency budget in milliseconds and a score cache size in (query, chunk) pairs
+RERANK_MODEL = os.environ.get("RERANK_MODEL", "")
+RERANK_BUDGET_MS = float(os.environ.get("RERANK_BUDGET_MS", "150"))
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", "20000"))
+
+# Token budget of the retrieved context in the prompt (0 disables the limit) and the HuggingFace
+# tokenizer used to count tokens (empty string uses an approximation of 4 characters per token)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1024"))
+CONTEXT_TOKENIZER = os.environ.get("CONTEXT_TOKENIZER", "")
+
+# Iterative deepening when the filter starves the results: the number of candidates
+# grows by RETRIEVAL_K_GROWTH per round, up to RETRIEVAL_MAX_K
+RETRIEVAL_MAX_K = int(os.environ.get("RETRIEVAL_MAX_K", "320"))
+RETRIEVAL_K_GROWTH = int(os.environ.get("RETRIEVAL_K_GROWTH", "2"))
+
+# Embedding and LLM backends. EMBEDDING_BACKEND=fake and LLM_MODEL=fake are deterministic stand-ins
+# without model weights or API calls (see fakes.py), used by benchmark.py; the fake LLM generates
+# FAKE_LLM_TOKENS tokens at FAKE_LLM_TOKEN_MS each and the fake embedding costs FAKE_EMBEDDING_MS per batch
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "angle")
+LLM_MODEL = os.environ.get("LLM_MODEL", "falcon-7b-instruct")
+FAKE_EMBEDDING_DIMENSION = int(os.environ.get("FAKE_EMBEDDING_DIMENSION", "1024"))
+FAKE_EMBEDDING_MS = float(os.environ.get("FAKE_EMBEDDING_MS", "20"))
+FAKE_LLM_TOKENS = int(os.environ.get("FAKE_LLM_TOKENS", "64"))
+FAKE_LLM_TOKEN_MS = float(os.environ.get("FAKE_LLM_TOKEN_MS", "20"))
+
+# Local LLM backends (see local_llm.py): LLM_MODEL=llamacpp runs the quantized GGUF model at
+# LLAMA_MODEL_PATH in-process, LLM_MODEL=llamacpp-server uses the llama.cpp server at LLAMA_SERVER_URL
+# (docker-compose service "llama", continuous batching over LLAMA_PARALLEL slots). Maximum generated
+# tokens per answer, generation threads (0 for all cores) and context window in tokens
+LLAMA_MODEL_PATH = os.environ.get("LLAMA_MODEL_PATH", "models/model.gguf")
+LLAMA_SERVER_URL = os.environ.get("LLAMA_SERVER_URL", "http://llama:8080")
+LLAMA_PARALLEL = int(os.environ.get("LLAMA_PARALLEL", "4"))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "256"))
+LLM_THREADS = int(os.environ.get("LLM_THREADS", "0"))
+LLM_CONTEXT_SIZE = int(os.environ.get("LLM_CONTEXT_SIZE", "2048"))
+
+# The in-process model generates one answer at a time: more admitted generations would wait for it
+# past their deadline instead of falling back to the references, so the LLM stage and its admission
+# slots are clamped to 1. The sidecar serves LLAMA_PARALLEL generations at once, unless STAGE_LIMIT_LLM is set
+if LLM_MODEL == "llamacpp":
+    STAGE_LIMIT_LLM = 1
+elif LLM_MODEL == "llamacpp-server" and "STAGE_LIMIT_LLM" not in os.environ:
+    STAGE_LIMIT_LLM = LLAMA_PARALLEL
+
+# Reuse the pre-filled key/value state of the static RAG prompt prefix across generations of the
+# local LLM backends instead of re-processing the instructions for every answer
+PROMPT_PREFIX_CACHE = os.environ.get("PROMPT_PREFIX_CACHE", "1") == "1"
+
+# Admission control of the LLM stage: the maximum number of queued generations per lane
+# (interactive requests are served before batch requests), the deadline of a request in seconds
+# per lane, and the minimum time a generation needs; a request that cannot get an LLM slot in
+# time returns its references without a generated answer
+LLM_QUEUE_INTERACTIVE = int(os.environ.get("LLM_QUEUE_INTERACTIVE", "32"))
+LLM_QUEUE_BATCH = int(os.environ.get("LLM_QUEUE_BATCH", "256"))
+REQUEST_DEADLINE_S = float(os.environ.get("REQUEST_DEADLINE_S", "60"))
+BATCH_REQUEST_DEADLINE_S = float(os.environ.get("BATCH_REQUEST_DEADLINE_S", "900"))
+LLM_MIN_TIME_S = float(os.environ.get("LLM_MIN_TIME_S", "2"))
+
+# Retrieval-only /search endpoint: default and maximum number of hits per page. Pages end at
+# RETRIEVAL_MAX_K results
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get("SEARCH_MAX_PAGE_SIZE", "50"))
+
+# Number of gunicorn worker processes (see gunicorn.conf.py), and whether the embedding weights
+# are loaded once in the master before forking so that the workers share them copy-on-write
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+PRELOAD_EMBEDDING_MODEL = os.environ.get("PRELOAD_EMBEDDING_MODEL", "1") == "1"
@@ -1,4 +1,5 @@
 import pandas as pd
+import torch
 from angle_emb import AnglE, Prompts
 from tqdm import tqdm
 import csv
@@ -30,7 +31,9 @@ def embed_data(source_file: str=None, destination_file: str=None, start_index: i
     df = df.dropna(subset=['abstract'])
 
     # Initialize AnglE embedding model
-    angle = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1', pooling_strategy='cls').cuda()
+    angle = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1', pooling_strategy='cls')
+    if torch.cuda.is_available():
+        angle = angle.cuda()
     angle.set_prompt(prompt=Prompts.C)   
 
     rows_list = []
@@ -3,6 +3,7 @@ import re, csv
 from openai import OpenAI
 import ast
 import time
+import torch
 from opensearchpy import OpenSearch
 from angle_emb import AnglE, Prompts
 import os
@@ -11,7 +12,9 @@ from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 
 # Initialize AnglE embedding model
-angle = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1', pooling_strategy='cls').cuda()
+angle = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1', pooling_strategy='cls')
+if torch.cuda.is_available():
+    angle = angle.cuda()
 # Enable Prompt.C for retrieval optimized embeddings
 angle.set_prompt(prompt=Prompts.C)   
 